@@ -0,0 +1,66 @@
+import tensorflow as tf
+import numpy as np
+import logging
+from time import time
+
+from DCM.Mesh import Mesh
+from DCM.PDE_Model import Helmholtz
+from NN.NeuralNet import PINN_NeuralNet
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# Residual loss and parameter gradient with nested tapes against the Taylor
+# mode forward pass of PINN_NeuralNet
+
+def benchmark(architecture, N=20000, repeats=20):
+
+    PDE = Helmholtz()
+    PDE.kappa = 0.125
+    domain = PDE.set_domain(([-10,10],[-10,10],[-10,10]))
+    mesh = Mesh(domain, mesh_N={'N_r': 10})
+
+    hyperparameters = {
+                'input_shape': (None,3),
+                'num_hidden_layers': 4,
+                'num_hidden_blocks': 2,
+                'num_neurons_per_layer': 40,
+                'output_dim': 1,
+                'activation': 'tanh',
+                'architecture_Net': architecture
+        }
+    model = PINN_NeuralNet(mesh.lb, mesh.ub, **hyperparameters)
+    model.build_Net()
+
+    X_r = tf.constant(np.random.uniform(-10,10,(N,3)), dtype='float32')
+    X = mesh.get_X(X_r)
+    F = PDE.residual_features(X)
+
+    def step():
+        PDE.clear_bundles()
+        with tf.GradientTape() as tape:
+            loss = PDE.residual_loss(mesh,model,X,F)
+        return loss, tape.gradient(loss, model.trainable_variables)
+
+    results = dict()
+    for derivatives in ['tape','taylor']:
+        PDE.derivatives = derivatives
+        PDE.clear_bundles()
+        lap = PDE.laplacian(mesh,model,X)
+        train_step = tf.function(step)
+        train_step()
+        t0 = time()
+        for i in range(repeats):
+            loss,grads = train_step()
+        float(loss)
+        results[derivatives] = ((time()-t0)/repeats, lap)
+
+    error = np.max(np.abs(results['tape'][1] - results['taylor'][1]))
+    logger.info(f'{architecture}: tape {results["tape"][0]*1000:.2f} ms, taylor {results["taylor"][0]*1000:.2f} ms, '
+                f'speedup {results["tape"][0]/results["taylor"][0]:.2f}, max laplacian difference {error:.2e}')
+
+
+if __name__=='__main__':
+    for architecture in ['FCNN','ResNet']:
+        benchmark(architecture)
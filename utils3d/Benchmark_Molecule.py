@@ -0,0 +1,60 @@
+import numpy as np
+import logging
+from time import time
+
+from DCM.Molecule import Molecule
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# Inside/outside classification throughput for a synthetic globular
+# molecule (atoms at protein density in a ball), checked against a brute
+# force test on a subset of the points
+
+def synthetic_molecule(N_atoms, seed=1234):
+    rng = np.random.default_rng(seed)
+    # about 0.1 atoms per cubic angstrom
+    R = np.cbrt(3*N_atoms/(4*np.pi*0.1))
+    u = rng.random(N_atoms)
+    d = rng.standard_normal((N_atoms,3))
+    d /= np.linalg.norm(d, axis=1, keepdims=True)
+    X = np.cbrt(u)[:,None]*R*d
+    r = rng.choice([1.2,1.5,1.7,1.8], N_atoms)
+    q = rng.uniform(-1,1,N_atoms)
+    return Molecule(X, r, q)
+
+
+def benchmark(N_atoms=10000, N_points=2000000, N_check=20000):
+
+    molecule = synthetic_molecule(N_atoms)
+    R = molecule.bounding_radius('sas')
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-R, R, (N_points,3))
+
+    for surface in ['vdw','sas','ses']:
+        t0 = time()
+        inside = molecule.inside(X, surface)
+        t = time() - t0
+
+        if surface == 'ses':
+            error = 'n/a'
+        else:
+            Y = X[:N_check]
+            radii = molecule.radii(surface)
+            brute = np.zeros(len(Y), dtype=bool)
+            for i in range(0, N_atoms, 500):
+                d = np.linalg.norm(Y[:,None,:] - molecule.X[None,i:i+500,:], axis=2)
+                brute |= np.any(d < radii[i:i+500], axis=1)
+            error = int(np.sum(brute != inside[:N_check]))
+        logger.info(f'{surface}: {N_points/t/1e6:.2f} Mpoints/s ({t:.2f} s), inside fraction {np.mean(inside):.3f}, '
+                    f'mismatches against brute force {error}')
+
+    for surface in ['vdw','ses']:
+        t0 = time()
+        XS,WS,nS = molecule.surface(200000, surface)
+        logger.info(f'{surface} surface: {len(XS)} points in {time()-t0:.2f} s')
+
+
+if __name__=='__main__':
+    benchmark()
@@ -0,0 +1,91 @@
+import numpy as np
+import tensorflow as tf
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Active_Set():
+
+    # Pruning of converged residual points. Training steps keep a running
+    # |residual| per point of X_r, every `every` epochs the points that have
+    # stayed below `threshold` for `patience` epochs leave the batches. A
+    # `retest` fraction of the pruned points is drawn back in at each update,
+    # and the active set is padded with them up to a multiple of `bucket` so
+    # batch shapes (and compiled steps) change only in coarse steps.
+
+    def __init__(self, PDE, threshold=1e-3, patience=100, every=10, retest=0.05, bucket=1024, decay=0.9, dtype='float32'):
+
+        self.DTYPE='float32'
+        self.PDE = PDE
+        self.threshold = threshold
+        self.patience = patience
+        self.every = every
+        self.retest = retest
+        self.bucket = bucket
+        self.decay = decay
+        self.dtype = dtype
+        self.values = None
+        self.reset()
+
+    def reset(self):
+        # rebuilt whenever the residual points change
+        X_F = self.PDE.X_r_F
+        if X_F is None:
+            raise ValueError('Active set pruning needs the residual points in memory')
+        N = len(X_F)
+        # indices travel as a float32 column, exact up to 2^24 points
+        index = tf.range(N, dtype=self.DTYPE)[:,None]
+        self.X_F = tf.concat([X_F, index], axis=1)
+        unseen = tf.fill([N], tf.constant(np.inf, dtype=self.dtype))
+        # one variable resized in place, compiled steps keep updating it when
+        # a curriculum level or a resample changes the number of points
+        if self.values is None:
+            self.values = tf.Variable(unseen, trainable=False, shape=tf.TensorShape([None]))
+        else:
+            self.values.assign(unseen)
+        self.count = np.zeros(N, dtype=np.int32)
+        self.active = np.arange(N)
+        self.X_active = self.X_F
+
+    def points(self):
+        return self.X_active
+
+    # Checkpoint state, restored after the residual points
+    def state(self):
+        return {'values': self.values.numpy(), 'count': self.count, 'active': self.active}
+
+    def load_state(self, arrays):
+        self.values.assign(tf.constant(arrays['values'], dtype=self.dtype))
+        self.count = arrays['count']
+        self.active = arrays['active']
+        self.X_active = tf.gather(self.X_F, self.active)
+
+    def due(self, iter):
+        return iter > 0 and iter % self.every == 0
+
+    def update(self, index, r):
+        # exponential average of |r| over the epochs a point is seen, the
+        # first visit sets it directly
+        index = tf.cast(index, tf.int32)
+        r = tf.cast(tf.abs(tf.stop_gradient(r[:,0])), self.dtype)
+        old = tf.gather(self.values, index)
+        new = tf.where(tf.math.is_inf(old), r, self.decay*old + (1-self.decay)*r)
+        self.values.scatter_nd_update(index[:,None], new)
+
+    def prune(self, seed):
+        values = self.values.numpy().astype(np.float32)
+        below = values < self.threshold
+        self.count = np.where(below, self.count + self.every, 0)
+        converged = np.where(self.count >= self.patience)[0]
+        active = np.where(self.count < self.patience)[0]
+
+        rng = np.random.default_rng(seed)
+        n = int(np.ceil(self.retest*len(converged)))
+        if self.bucket > 0:
+            n += -(len(active) + n) % self.bucket
+        retest = rng.choice(converged, min(n, len(converged)), replace=False)
+
+        self.active = np.sort(np.concatenate([active, retest]))
+        self.X_active = tf.gather(self.X_F, self.active)
+        logger.info(f'Active set: {len(self.active)} of {len(values)} points, {len(converged)} converged')
@@ -0,0 +1,88 @@
+import numpy as np
+import tensorflow as tf
+import copy
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Adaptive_Sampler():
+
+    # Residual based adaptive resampling (RAR). Every `every` epochs a fresh
+    # candidate pool is scored by the absolute PDE residual, and the lowest
+    # scoring fraction of the active residual points is replaced by the
+    # highest scoring candidates. The active set keeps its size, so batch
+    # shapes and compiled steps are unchanged.
+
+    def __init__(self, PDE, every=100, N_candidates=100000, fraction=0.1, block_size=2**15):
+
+        self.DTYPE='float32'
+        if 'weight' in PDE.feature_names[False]:
+            raise ValueError('Adaptive resampling needs an unweighted residual set')
+        self.PDE = PDE
+        self.every = every
+        self.N_candidates = N_candidates
+        self.fraction = fraction
+        self.block_size = block_size
+        self.scores = dict()
+
+    def due(self, iter):
+        return iter > 0 and iter % self.every == 0
+
+    def score_fn(self, model):
+        if id(model) not in self.scores:
+            def score(X_batch):
+                X_batch,F = self.PDE.split_features(X_batch)
+                self.PDE.clear_bundles()
+                r = self.PDE.residual(self.PDE.mesh,model,self.PDE.mesh.get_X(X_batch),F)
+                return tf.abs(r[:,0])
+            self.scores[id(model)] = tf.function(score)
+        return self.scores[id(model)]
+
+    def score(self, X_F, model):
+        score = self.score_fn(model)
+        return np.concatenate([score(X_F[i:i+self.block_size]).numpy() for i in range(0, len(X_F), self.block_size)])
+
+    def candidates(self, seed):
+        # same region as the residual mesh, a new seed each time
+        mesh = self.PDE.mesh
+        sampler = copy.copy(mesh.domain_sampler)
+        sampler.seed = seed
+        X = sampler.points('uniform', self.N_candidates, mesh.ins_domain['rmin'], mesh.ins_domain['rmax'])
+        return self.PDE.with_features(tf.constant(X))
+
+    def set_points(self, X_F):
+        self.PDE.X_r_F = X_F
+        self.PDE.X_r = X_F[:,:3]
+        self.PDE.x,self.PDE.y,self.PDE.z = self.PDE.mesh.get_X(self.PDE.X_r)
+        if self.PDE.active_set != None:
+            self.PDE.active_set.reset()
+
+    # Checkpoint state: the resampled points, their features are computed
+    # again on restore
+    def state(self):
+        if self.PDE.X_r_F is None:
+            return dict()
+        return {'X_r': self.PDE.X_r_F[:,:3].numpy()}
+
+    def load_state(self, arrays):
+        if 'X_r' in arrays:
+            self.set_points(self.PDE.with_features(tf.constant(arrays['X_r'])))
+
+    def resample(self, model, seed):
+        # streamed (sharded) residual sets are left as they are
+        X_F = self.PDE.X_r_F
+        if X_F is None:
+            return
+        n = min(int(self.fraction*len(X_F)), self.N_candidates)
+        if n == 0:
+            return
+
+        C_F = self.candidates(seed)
+        s_X = self.score(X_F, model)
+        s_C = self.score(C_F, model)
+
+        keep = np.sort(np.argsort(s_X)[n:])
+        new = np.argsort(s_C)[-n:]
+        self.set_points(tf.concat([tf.gather(X_F,keep), tf.gather(C_F,new)], axis=0))
+        logger.info(f'RAR: replaced {n} points, mean residual {np.mean(s_X):.3e} -> {np.mean(np.concatenate([s_X[keep],s_C[new]])):.3e}')
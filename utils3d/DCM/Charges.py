@@ -0,0 +1,108 @@
+import numpy as np
+import tensorflow as tf
+from scipy.spatial import cKDTree
+
+from DCM.Treecode import Treecode, pairwise_kernel
+
+
+class Charges():
+
+    def __init__(self, q_list, block_size=2**22, treecode=None):
+
+        self.DTYPE='float32'
+        self.q_list = q_list
+        self.q = np.array([qk for qk,Xk in q_list], dtype=np.float64)
+        self.X = np.array([Xk for qk,Xk in q_list], dtype=np.float64).reshape(-1,3)
+        self.total = float(np.sum(self.q))
+        # pairwise kernels are evaluated on blocks of about block_size pairs
+        self.block_size = block_size
+        self.tree = None
+        # far field sums go through a treecode when its parameters are given,
+        # e.g. {'theta': 0.7, 'degree': 6}
+        self.treecode_params = treecode
+        self.treecode = None
+
+    def __len__(self):
+        return len(self.q)
+
+    def get_tree(self):
+        if self.tree is None:
+            self.tree = cKDTree(self.X)
+        return self.tree
+
+    def get_treecode(self):
+        if self.treecode is None:
+            self.treecode = Treecode(self.X, self.q, **self.treecode_params)
+        return self.treecode
+
+
+    # Kernels on numpy arrays of points (N,3), accumulated in float64
+
+    def gaussian_sum(self, X, sigma, cutoff=None):
+        # sum_k q_k exp(-|x-x_k|^2/(2 sigma^2)) over the charges within the
+        # cutoff, found with a KD-tree instead of all point-charge pairs
+        if cutoff is None:
+            cutoff = 6*sigma
+        tree_X = cKDTree(X)
+        pairs = tree_X.sparse_distance_matrix(self.get_tree(), cutoff, output_type='ndarray')
+        values = self.q[pairs['j']]*np.exp(-pairs['v']**2/(2*sigma**2))
+        return np.bincount(pairs['i'], weights=values, minlength=len(X))
+
+    def kernel_sum(self, X, kind, kappa=0, normals=None):
+        # sum_k q_k G(x,x_k) or its normal derivative, direct on blocks of
+        # points or through the treecode
+        if self.treecode_params != None:
+            return self.get_treecode().evaluate(X, kind, kappa, normals)
+        out = np.zeros(len(X))
+        n = max(1, self.block_size//max(len(self),1))
+        for i in range(0, len(X), n):
+            n_b = normals[i:i+n] if normals is not None else None
+            out[i:i+n] = pairwise_kernel(X[i:i+n], self.X, kind, kappa, n_b)@self.q
+        return out
+
+    def coulomb_sum(self, X):
+        return self.kernel_sum(X, 'coulomb')
+
+    def inverse_square_sum(self, X):
+        return self.kernel_sum(X, 'inverse_square')
+
+    def screened_sum(self, X, kappa):
+        return self.kernel_sum(X, 'screened', kappa)
+
+    def normal_sum(self, XN, kind, kappa=0):
+        # XN holds the points followed by their normals
+        return self.kernel_sum(XN[:,:3], kind, kappa, XN[:,3:])
+
+
+    # Evaluation on the (x,y,z) columns used by the PDE models. Eager tensors
+    # and numpy values are computed directly, symbolic tensors (tf.data
+    # pipelines) go through numpy_function.
+
+    def evaluate(self, kernel, columns, *args):
+        if not any(isinstance(v,(tf.Tensor,tf.Variable)) for v in columns):
+            columns = np.broadcast_arrays(*[np.asarray(v,dtype=np.float64) for v in columns])
+            X = np.stack([v.ravel() for v in columns], axis=1)
+            return kernel(X,*args).reshape(columns[0].shape)
+
+        X = tf.concat([tf.reshape(tf.cast(v,self.DTYPE),[-1,1]) for v in columns], axis=1)
+        if tf.executing_eagerly():
+            return tf.constant(kernel(X.numpy().astype(np.float64),*args).reshape(-1,1), dtype=self.DTYPE)
+        fun = lambda X: kernel(X.astype(np.float64),*args).astype(self.DTYPE)
+        out = tf.numpy_function(fun, [X], self.DTYPE)
+        return tf.reshape(out, [-1,1])
+
+    def gaussian(self, x, y, z, sigma, cutoff=None):
+        return self.evaluate(self.gaussian_sum, (x,y,z), sigma, cutoff)
+
+    def coulomb(self, x, y, z):
+        return self.evaluate(self.coulomb_sum, (x,y,z))
+
+    def inverse_square(self, x, y, z):
+        return self.evaluate(self.inverse_square_sum, (x,y,z))
+
+    def screened_coulomb(self, x, y, z, kappa):
+        return self.evaluate(self.screened_sum, (x,y,z), kappa)
+
+    def normal_derivative(self, x, y, z, n, kind='coulomb', kappa=0):
+        nx,ny,nz = n
+        return self.evaluate(self.normal_sum, (x,y,z,nx,ny,nz), kind, kappa)
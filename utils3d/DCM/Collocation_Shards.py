@@ -0,0 +1,116 @@
+import numpy as np
+import tensorflow as tf
+import json
+import os
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Collocation_Shards():
+
+    def __init__(self, directory):
+
+        self.DTYPE='float32'
+        self.directory = directory
+        self.files = list()
+        self.sizes = list()
+        self.size = 0
+        # x,y,z and an optional quadrature weight
+        self.columns = 3
+        if os.path.exists(self.manifest_path()):
+            self.open()
+
+    def manifest_path(self):
+        return os.path.join(self.directory,'manifest.json')
+
+    def open(self):
+        with open(self.manifest_path()) as f:
+            manifest = json.load(f)
+        self.files = [os.path.join(self.directory,file) for file in manifest['files']]
+        self.sizes = manifest['sizes']
+        self.columns = manifest.get('columns',3)
+        self.size = int(np.sum(self.sizes))
+
+    def write(self, blocks, shard_size=2**20):
+        tmp = self.directory + f'.tmp{os.getpid()}'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        files = list()
+        sizes = list()
+        buffer = None
+        n = 0
+
+        def flush(n):
+            file = f'shard_{len(files)}.npy'
+            np.save(os.path.join(tmp,file), buffer[:n])
+            files.append(file)
+            sizes.append(n)
+
+        for block in blocks:
+            if buffer is None:
+                buffer = np.empty((shard_size,block.shape[1]), dtype=self.DTYPE)
+            i = 0
+            while i < len(block):
+                m = min(shard_size - n, len(block) - i)
+                buffer[n:n+m] = block[i:i+m]
+                n += m
+                i += m
+                if n == shard_size:
+                    flush(n)
+                    n = 0
+        if buffer is None:
+            buffer = np.empty((0,3), dtype=self.DTYPE)
+        if n > 0 or len(files) == 0:
+            flush(n)
+
+        with open(os.path.join(tmp,'manifest.json'),'w') as f:
+            json.dump({'files': files, 'sizes': sizes, 'columns': buffer.shape[1]}, f)
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.replace(tmp, self.directory)
+        self.open()
+        logger.info(f'Collocation shards written: {self.size} points in {len(files)} shards')
+
+
+    def read_shard(self, file, chunk=2**16):
+        # slices of the memory mapped shard, only the chunk being read is
+        # copied to memory
+        X = np.load(file.decode(), mmap_mode='r')
+        for i in range(0, len(X), chunk):
+            yield np.array(X[i:i+chunk])
+
+    def sample(self, N):
+        X = np.load(self.files[0], mmap_mode='r')
+        return tf.constant(np.array(X[:N]))
+
+    # Shuffled minibatches streamed from the shards, one epoch. Shards are
+    # read in parallel and in random order, points are mixed in a shuffle
+    # buffer and batches are prefetched so reading overlaps the train step.
+    # A seed (an int64 tensor for epochs of a longer pipeline) makes the
+    # order reproducible.
+    def dataset(self, batch_size, shuffle_buffer=2**20, cycle_length=4, drop_remainder=False, seed=None):
+        files = tf.data.Dataset.from_tensor_slices(self.files)
+        files = files.shuffle(len(self.files), seed=seed, reshuffle_each_iteration=True)
+
+        def load(file):
+            chunks = tf.data.Dataset.from_generator(self.read_shard, args=(file,),
+                                                    output_signature=tf.TensorSpec([None,self.columns], tf.float32))
+            return chunks.unbatch()
+
+        points = files.interleave(load,
+                                  cycle_length=cycle_length,
+                                  num_parallel_calls=tf.data.AUTOTUNE,
+                                  deterministic=seed is not None)
+        points = points.shuffle(min(shuffle_buffer,self.size), seed=seed, reshuffle_each_iteration=True)
+        batches = points.batch(batch_size, drop_remainder=drop_remainder)
+        return batches.prefetch(tf.data.AUTOTUNE)
+
+    def batches(self, batch_size, drop_remainder=False):
+        # batches in one epoch of dataset
+        if drop_remainder:
+            return self.size//batch_size
+        return -(-self.size//batch_size)
@@ -0,0 +1,227 @@
+import numpy as np
+import warnings
+from scipy.stats import qmc, truncnorm
+
+from DCM.Surface_Sampler import Surface_Sampler
+from DCM.Charges import Charges
+
+
+class Domain_Sampler():
+
+    def __init__(self, lb, ub, block_size=2**20, seed=1234, layout='gauss_product', grading=None):
+
+        self.DTYPE='float32'
+        self.lb = np.array(lb, dtype=np.float64)
+        self.ub = np.array(ub, dtype=np.float64)
+        self.block_size = int(block_size)
+        self.seed = seed
+        # optional boolean function on (N,3) points that keeps a subregion
+        self.mask = None
+        # spherical layout of the cubature sampler
+        self.layout = layout
+        # mixture of the graded sampler, see graded_blocks
+        self.grading = dict() if grading is None else grading
+        self.samplers = {
+            'grid': self.grid_blocks,
+            'uniform': self.uniform_blocks,
+            'sobol': self.sobol_blocks,
+            'halton': self.halton_blocks,
+            'cubature': self.cubature_blocks,
+            'graded': self.graded_blocks
+        }
+        # samplers giving exactly N points, the others give about N
+        self.exact = ['uniform','sobol','halton','graded']
+
+    def blocks(self, sampler, N, rmin, rmax):
+        if sampler not in self.samplers:
+            raise ValueError(f'Unknown domain sampler: {sampler}')
+        return self.samplers[sampler](N, rmin, rmax)
+
+    # Blocks hold the points, weighted samplers add a fourth column with
+    # quadrature weights normalized to mean 1 over the shell
+    def points(self, sampler, N, rmin, rmax):
+        if sampler not in self.exact:
+            return np.concatenate(list(self.blocks(sampler, N, rmin, rmax)), axis=0)
+        # exact-count samplers fill a preallocated array block by block
+        X = np.empty((N,4 if self.weighted(sampler) else 3), dtype=self.DTYPE)
+        i = 0
+        for block in self.blocks(sampler, N, rmin, rmax):
+            X[i:i+len(block)] = block
+            i += len(block)
+        return X
+
+    def weighted(self, sampler):
+        return sampler in ['cubature','graded']
+
+    # draws in a row without an accepted point before the shell is taken to
+    # lie outside the mask (molecule outside rmin/rmax, rmax too small)
+    max_rejected = 2**20
+
+    def count_rejected(self, rejected, n, accepted, rmin, rmax):
+        rejected = 0 if accepted > 0 else rejected + n
+        if rejected >= self.max_rejected:
+            raise ValueError(f'The mask rejects every point of the shell {rmin} < r < {rmax}')
+        return rejected
+
+
+    # Same points and order as meshgrid + masking of the N^3 cube,
+    # built a few y-rows at a time
+    def grid_blocks(self, N, rmin, rmax):
+        xspace = np.linspace(self.lb[0], self.ub[0], N, dtype=self.DTYPE)
+        yspace = np.linspace(self.lb[1], self.ub[1], N, dtype=self.DTYPE)
+        zspace = np.linspace(self.lb[2], self.ub[2], N, dtype=self.DTYPE)
+
+        rows = max(1, self.block_size//(N*N))
+        for i in range(0, N, rows):
+            Y, X, Z = np.meshgrid(yspace[i:i+rows], xspace, zspace, indexing='ij')
+            r = np.sqrt(X**2 + Y**2 + Z**2)
+            inside = (r < rmax) & (r > rmin)
+            block = np.stack([X[inside], Y[inside], Z[inside]], axis=1)
+            if self.mask != None:
+                block = block[self.mask(block)]
+            yield block
+
+    # Exactly N points uniformly distributed in the shell rmin < r < rmax,
+    # rejected points of the mask are drawn again
+    def uniform_blocks(self, N, rmin, rmax):
+        rng = np.random.default_rng(self.seed)
+        rmin = max(rmin, 0)
+        i,rejected = 0,0
+        while i < N:
+            n = min(self.block_size, N - i)
+            u = rng.random(n)
+            r = np.cbrt(rmin**3 + u*(rmax**3 - rmin**3))
+            d = rng.standard_normal((n,3))
+            d /= np.linalg.norm(d, axis=1, keepdims=True)
+            block = (r[:,None]*d).astype(self.DTYPE)
+            if self.mask != None:
+                block = block[self.mask(block)]
+            rejected = self.count_rejected(rejected, n, len(block), rmin, rmax)
+            i += len(block)
+            yield block
+
+    # Low discrepancy points of the unit cube mapped to the shell, uniform
+    # in volume. Points rejected by the mask are replaced by the next ones
+    def qmc_blocks(self, engine, N, rmin, rmax):
+        rmin = max(rmin, 0)
+        i,rejected = 0,0
+        while i < N:
+            n = min(self.block_size, N - i)
+            with warnings.catch_warnings():
+                # Sobol balance warnings for counts that are not powers of 2
+                warnings.simplefilter('ignore')
+                U = engine.random(n)
+            r = np.cbrt(rmin**3 + U[:,0]*(rmax**3 - rmin**3))
+            z = 1 - 2*U[:,1]
+            rho = np.sqrt(1 - z**2)
+            phi = 2*np.pi*U[:,2]
+            block = (r[:,None]*np.stack([rho*np.cos(phi), rho*np.sin(phi), z], axis=1)).astype(self.DTYPE)
+            if self.mask != None:
+                block = block[self.mask(block)]
+            rejected = self.count_rejected(rejected, n, len(block), rmin, rmax)
+            i += len(block)
+            yield block
+
+    def sobol_blocks(self, N, rmin, rmax):
+        return self.qmc_blocks(qmc.Sobol(d=3, scramble=True, seed=self.seed), N, rmin, rmax)
+
+    def halton_blocks(self, N, rmin, rmax):
+        return self.qmc_blocks(qmc.Halton(d=3, scramble=True, seed=self.seed), N, rmin, rmax)
+
+    # Gauss-Legendre radii times a spherical layout, about N points with
+    # weights r^2 w_r w_angle. One radial shell per block
+    def cubature_blocks(self, N, rmin, rmax):
+        rmin = max(rmin, 0)
+        N_rad = max(1, int(round(np.cbrt(N)/2)))
+        U,w_a = Surface_Sampler().layouts[self.layout](int(np.ceil(N/N_rad)))
+        x,w = np.polynomial.legendre.leggauss(N_rad)
+        r = rmin + (x + 1)*(rmax - rmin)/2
+        w_r = w*(rmax - rmin)/2*r**2
+        scale = N_rad*len(U)/(np.sum(w_r)*np.sum(w_a))
+        for r_k,w_k in zip(r,w_r):
+            block = np.concatenate([r_k*U, (scale*w_k*w_a)[:,None]], axis=1).astype(self.DTYPE)
+            if self.mask != None:
+                block = block[self.mask(block[:,:3])]
+            yield block
+
+    # Importance sampling driven by the problem: a mixture of uniform points
+    # in the shell, radial grading with density ~ r^-gamma, a normal band of
+    # width 'band' around 'rI' and gaussians of scale 'charge_scale' around
+    # the 'centers' (charge positions). Fractions 'radial', 'interface' and
+    # 'charges' are taken from N, the rest stays uniform, which bounds the
+    # weights by 1/fraction. Weights 1/(V q(x)) make the mean of w*f an
+    # unbiased estimate of the mean of f over the shell.
+    def graded_blocks(self, N, rmin, rmax):
+        g = self.grading
+        rng = np.random.default_rng(self.seed)
+        rmin = max(rmin, 0)
+        V = 4/3*np.pi*(rmax**3 - rmin**3)
+
+        centers = np.array(g.get('centers', []), dtype=np.float64).reshape(-1,3)
+        a_r = g.get('radial', 0)
+        a_I = g.get('interface', 0) if g.get('rI') != None else 0
+        a_c = g.get('charges', 0) if len(centers) > 0 else 0
+        a_u = 1 - a_r - a_I - a_c
+        if a_u <= 0:
+            raise ValueError('Graded sampler needs a uniform fraction above 0')
+
+        # radial grading, inverse CDF of r^(2-gamma) on [r_lo,rmax]
+        k = 3 - g.get('gamma', 2)
+        r_lo = max(rmin, 1e-3*rmax)
+        def radial_r(u):
+            if k == 0:
+                return r_lo*(rmax/r_lo)**u
+            return (r_lo**k + u*(rmax**k - r_lo**k))**(1/k)
+        def radial_p(r):
+            if k == 0:
+                p = 1/(r*np.log(rmax/r_lo))
+            else:
+                p = k*r**(k-1)/(rmax**k - r_lo**k)
+            return np.where(r >= r_lo, p, 0)
+
+        if a_I > 0:
+            width = g.get('band', 0.1)
+            band = truncnorm((rmin - g['rI'])/width, (rmax - g['rI'])/width, loc=g['rI'], scale=width)
+
+        if a_c > 0:
+            scale = g.get('charge_scale', 0.1)
+            gaussians = Charges([(1,c) for c in centers])
+            norm = 1/(len(centers)*(2*np.pi*scale**2)**1.5)
+            # mass of the charge gaussians inside the shell
+            test = centers[rng.integers(len(centers), size=2**18)] + scale*rng.standard_normal((2**18,3))
+            r_test = np.linalg.norm(test, axis=1)
+            Z = np.mean((r_test > rmin) & (r_test < rmax))
+        # charge points outside the shell are rejected, P is the accepted mass
+        P = a_u + a_r + a_I + (a_c*Z if a_c > 0 else 0)
+
+        def directions(n):
+            d = rng.standard_normal((n,3))
+            return d/np.linalg.norm(d, axis=1, keepdims=True)
+
+        i,rejected = 0,0
+        while i < N:
+            n = min(self.block_size, N - i)
+            n_u,n_r,n_I,n_c = rng.multinomial(n, [a_u,a_r,a_I,a_c])
+            X = [np.cbrt(rmin**3 + rng.random(n_u)*(rmax**3 - rmin**3))[:,None]*directions(n_u),
+                 radial_r(rng.random(n_r))[:,None]*directions(n_r)]
+            if n_I > 0:
+                X.append(band.rvs(size=n_I, random_state=rng)[:,None]*directions(n_I))
+            if n_c > 0:
+                X.append(centers[rng.integers(len(centers), size=n_c)] + scale*rng.standard_normal((n_c,3)))
+            X = rng.permutation(np.concatenate(X))
+            r = np.linalg.norm(X, axis=1)
+            X = X[(r > rmin) & (r < rmax)]
+            if self.mask != None:
+                X = X[self.mask(X)]
+            rejected = self.count_rejected(rejected, n, len(X), rmin, rmax)
+            X = X[:N-i]
+
+            r = np.linalg.norm(X, axis=1)
+            q = a_u/V + a_r*radial_p(r)/(4*np.pi*r**2)
+            if a_I > 0:
+                q += a_I*band.pdf(r)/(4*np.pi*r**2)
+            if a_c > 0:
+                q += a_c*norm*gaussians.gaussian_sum(X, scale)
+            q /= P
+            i += len(X)
+            yield np.concatenate([X, (1/(V*q))[:,None]], axis=1).astype(self.DTYPE)
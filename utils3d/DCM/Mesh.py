@@ -2,6 +2,14 @@ import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
 import os
+import json
+import hashlib
+
+from DCM.Surface_Sampler import Surface_Sampler
+from DCM.Domain_Sampler import Domain_Sampler
+from DCM.Collocation_Shards import Collocation_Shards
+from DCM.Stream_Sampler import Stream_Sampler
+from DCM.Molecule import Molecule
 
 
 class Mesh():
@@ -15,6 +23,9 @@ class Mesh():
         self.lb = domain[0]
         self.ub = domain[1]
         self.precondition = precondition
+        self.sampler = Surface_Sampler()
+        self.domain_sampler = Domain_Sampler(self.lb, self.ub, block_size=mesh_N.get('block_size',2**20), layout=mesh_N.get('layout','gauss_product'), grading=mesh_N.get('grading'))
+        self.molecules = dict()
 
     def get_X(self,X):
         R = list()
@@ -27,36 +38,73 @@ class Mesh():
         return R
 
 
-    def create_mesh(self,borders,ins_domain):
+    def create_mesh(self,borders,ins_domain,store=None):
 
         self.borders = borders
         self.ins_domain = ins_domain
         self.XD_data = list()
         self.UD_data = list()
+        self.WD_data = list()
         self.XN_data = list()
         self.UN_data = list()
+        self.WN_data = list()
+        self.NN_data = list()
         self.XK_data = list()
         self.UK_data = list()
+        self.WK_data = list()
         self.derN = list()
         self.XI_data = list()
+        self.WI_data = list()
+        self.NI_data = list()
         self.derI = list()
         self.BP = list()
         self.X_r_P = None
-
+        self.W_r = None
+        self.W_r_P = None
+        self.X_r_shards = None
+        self.X_r_P_shards = None
+        self.X_r_stream = None
+        self.X_r_P_stream = None
+        self.domain_sampler.mask = self.domain_mask()
+        # borders are always sampled, their values are part of the cache key
         self.create_borders_mesh()
 
-        self.create_domain_mesh()
+        if store != None:
+            key = store.key(self)
+
+        if store != None and store.has(key):
+            store.load(key,self)
+            if 'rmin' not in self.ins_domain:
+                self.ins_domain['rmin'] = -0.1
+            # streams hold no points, they are set up again
+            if self.mesh_N.get('stream', False):
+                self.create_domain_mesh()
+                if self.precondition:
+                    self.create_precondition_mesh()
+        else:
+            self.create_domain_mesh()
+
+            if self.precondition:
+                self.create_precondition_mesh()
 
-        if self.precondition:
-            self.create_precondition_mesh()
+            if store != None:
+                store.save(key,self)
 
         self.data_mesh = {
             'residual': self.X_r,
-            'dirichlet': (self.XD_data,self.UD_data),
-            'neumann': (self.XN_data,self.UN_data,self.derN),
-            'data_known': (self.XK_data, self.UK_data),
-            'interface': (self.XI_data,self.derI),
-            'precondition': self.X_r_P
+            'residual_weights': self.W_r,
+            'precondition_weights': self.W_r_P,
+            'dirichlet': (self.XD_data,self.UD_data,self.WD_data),
+            'neumann': (self.XN_data,self.UN_data,self.derN,self.WN_data),
+            'neumann_normals': self.NN_data,
+            'data_known': (self.XK_data,self.UK_data,self.WK_data),
+            'interface': (self.XI_data,self.derI,self.WI_data),
+            'interface_normals': self.NI_data,
+            'precondition': self.X_r_P,
+            'residual_shards': self.X_r_shards,
+            'precondition_shards': self.X_r_P_shards,
+            'residual_stream': self.X_r_stream,
+            'precondition_stream': self.X_r_P_stream
         }
 
     def create_borders_mesh(self):
@@ -67,32 +115,52 @@ class Mesh():
             N_b = bl['N']
             
             if R != None:
-        
-                r_bl = np.linspace(R, R, N_b, dtype=self.DTYPE)
-                theta_bl = np.linspace(0, self.pi, N_b, dtype=self.DTYPE)
-                phi_bl = np.linspace(0, 2*self.pi, N_b, dtype=self.DTYPE)
-                
-                R_bl, Theta_bl, Phi_bl = np.meshgrid(r_bl, theta_bl, phi_bl)
-                X_bl = R_bl*np.sin(Theta_bl)*np.cos(Phi_bl)
-                Y_bl = R_bl*np.sin(Theta_bl)*np.sin(Phi_bl)
-                Z_bl = R_bl*np.cos(Theta_bl)
-                
-                x_bl = tf.constant(X_bl.flatten())
-                x_bl = tf.reshape(x_bl,[x_bl.shape[0],1])
-                y_bl = tf.constant(Y_bl.flatten())
-                y_bl = tf.reshape(y_bl,[y_bl.shape[0],1])
-                z_bl = tf.constant(Z_bl.flatten())
-                z_bl = tf.reshape(z_bl,[z_bl.shape[0],1])
-            
-                XX_bl = tf.concat([x_bl, y_bl, z_bl], axis=1)
-                self.add_data_borders(bl,x_bl,y_bl,z_bl,XX_bl)
-                self.BP.append((x_bl,y_bl,z_bl))
 
-            else:
-                pass
+                # about N_b**2 unique points (exactly for fibonacci), the
+                # resolution of the former (theta,phi) grid
+                layout = bl.get('sampler', 'fibonacci')
+                X_np,W_np = self.sampler.sample(R, N_b**2, layout)
+                n_np = X_np/np.linalg.norm(X_np, axis=1, keepdims=True)
+
+            elif 'molecule' in bl:
+                # points on the molecular surface with their outward normals
+                molecule = self.get_molecule(bl)
+                X_np,W_np,n_np = molecule.surface(N_b**2, bl.get('surface','vdw'), bl.get('sampler','fibonacci'))
 
+            else:
+                continue
 
-    def add_data_borders(self,border,x1,x2,x3,X):
+            x_bl = tf.constant(X_np[:,0:1])
+            y_bl = tf.constant(X_np[:,1:2])
+            z_bl = tf.constant(X_np[:,2:3])
+            w_bl = tf.constant(W_np[:,None])
+        
+            XX_bl = tf.concat([x_bl, y_bl, z_bl], axis=1)
+            self.add_data_borders(bl,x_bl,y_bl,z_bl,XX_bl,w_bl,tf.constant(n_np))
+            self.BP.append((x_bl,y_bl,z_bl))
+
+
+    def get_molecule(self,config):
+        key = (config['molecule'], config.get('probe',1.4))
+        if key not in self.molecules:
+            self.molecules[key] = Molecule.load(config['molecule'], probe=key[1])
+        return self.molecules[key]
+
+    def domain_mask(self):
+        # a molecule in ins_domain restricts the collocation points to the
+        # solute ('side': 'in') or to the solvent ('side': 'out')
+        if 'molecule' not in self.ins_domain:
+            return None
+        molecule = self.get_molecule(self.ins_domain)
+        surface = self.ins_domain.get('surface','vdw')
+        if self.ins_domain.get('side','in') == 'in':
+            if 'rmax' not in self.ins_domain:
+                self.ins_domain['rmax'] = molecule.bounding_radius(surface)
+            return lambda X: molecule.inside(X, surface)
+        return lambda X: ~molecule.inside(X, surface)
+
+
+    def add_data_borders(self,border,x1,x2,x3,X,W,N=None):
         type_b = border['type']
         value = border['value']
         fun = border['fun']
@@ -104,6 +172,7 @@ class Mesh():
                 u_b = fun(x1, x2, x3)
             self.XD_data.append(X)
             self.UD_data.append(u_b)
+            self.WD_data.append(W)
         elif type_b == 'N':
             if fun == None:
                 ux_b = self.value_ux_b(x1, x2, x3, value=value)
@@ -111,9 +180,13 @@ class Mesh():
                 ux_b = fun(x1, x2, x3)
             self.XN_data.append(X)
             self.UN_data.append(ux_b)
+            self.WN_data.append(W)
+            self.NN_data.append(N)
             self.derN.append(deriv)
         elif type_b == 'I':
             self.XI_data.append(X)
+            self.WI_data.append(W)
+            self.NI_data.append(N)
         elif type_b == 'K':
             if fun == None:
                 u_b = self.value_u_b(x1, x2, x3, value=value)
@@ -121,6 +194,7 @@ class Mesh():
                 u_b = fun(x1, x2, x3)
             self.XK_data.append(X)
             self.UK_data.append(u_b)
+            self.WK_data.append(W)
         
 
 
@@ -136,53 +210,88 @@ class Mesh():
     def create_domain_mesh(self):
        #crear dominio circular (cascaron para generalizar)
         N_r = self.mesh_N['N_r']
-        xspace = np.linspace(self.lb[0], self.ub[0], N_r, dtype=self.DTYPE)
-        yspace = np.linspace(self.lb[1], self.ub[1], N_r, dtype=self.DTYPE)
-        zspace = np.linspace(self.lb[2], self.ub[2], N_r, dtype=self.DTYPE)
-        X, Y, Z = np.meshgrid(xspace, yspace, zspace)
 
         if 'rmin' not in self.ins_domain:
             self.ins_domain['rmin'] = -0.1
 
-        r = np.sqrt(X**2 + Y**2 + Z**2)
-        inside1 = r < self.ins_domain['rmax']
-        X1 = X[inside1]
-        Y1 = Y[inside1]
-        Z1 = Z[inside1]
-        r = np.sqrt(X1**2 + Y1**2 + Z1**2)
-        inside = r > self.ins_domain['rmin']
+        if self.mesh_N.get('stream', False):
+            self.X_r = None
+            self.X_r_stream = self.create_stream(N_r, self.ins_domain['rmin'], self.ins_domain['rmax'])
+            return
+
+        if 'shards' in self.mesh_N:
+            self.X_r = None
+            self.X_r_shards = self.create_shards('residual', N_r, self.ins_domain['rmin'], self.ins_domain['rmax'])
+            return
 
-        self.X_r = tf.constant(np.vstack([X1[inside].flatten(),Y1[inside].flatten(), Z1[inside].flatten()]).T)
+        X_r = self.domain_sampler.points(self.mesh_N.get('sampler','grid'), N_r, self.ins_domain['rmin'], self.ins_domain['rmax'])
+        self.X_r,self.W_r = self.split_weights(X_r)
 
 
 
     def create_precondition_mesh(self):
        #crear dominio circular (cascaron para generalizar)
         N_r = self.mesh_N['N_r_P']
-        xspace = np.linspace(self.lb[0], self.ub[0], N_r, dtype=self.DTYPE)
-        yspace = np.linspace(self.lb[1], self.ub[1], N_r, dtype=self.DTYPE)
-        zspace = np.linspace(self.lb[2], self.ub[2], N_r, dtype=self.DTYPE)
-        X, Y, Z = np.meshgrid(xspace, yspace, zspace)
         
         if 'rmin' not in self.ins_domain:
             precon_rmin = -0.02
         else:
             precon_rmin = 0.5*self.ins_domain['rmin']
 
-        r = np.sqrt(X**2 + Y**2 + Z**2)
-        inside1 = r < self.ins_domain['rmax']
-        X1 = X[inside1]
-        Y1 = Y[inside1]
-        Z1 = Z[inside1]
-        r = np.sqrt(X1**2 + Y1**2 + Z1**2)
-   
-        inside_P = r > precon_rmin
-        self.X_r_P = tf.constant(np.vstack([X1[inside_P].flatten(),Y1[inside_P].flatten(), Z1[inside_P].flatten()]).T)
+        if self.mesh_N.get('stream', False):
+            self.X_r_P = None
+            self.X_r_P_stream = self.create_stream(N_r, precon_rmin, self.ins_domain['rmax'])
+            return
+
+        if 'shards' in self.mesh_N:
+            self.X_r_P = None
+            self.X_r_P_shards = self.create_shards('precondition', N_r, precon_rmin, self.ins_domain['rmax'])
+            return
+
+        X_r_P = self.domain_sampler.points(self.mesh_N.get('sampler','grid'), N_r, precon_rmin, self.ins_domain['rmax'])
+        self.X_r_P,self.W_r_P = self.split_weights(X_r_P)
+
+    def split_weights(self, X):
+        # cubature points come with their quadrature weights in a fourth column
+        if X.shape[1] > 3:
+            return tf.constant(X[:,:3]), tf.constant(X[:,3:])
+        return tf.constant(X), None
+
+
+    def create_stream(self, N, rmin, rmax):
+        # fresh points each epoch, only for the sphere and shell geometries
+        if self.domain_sampler.mask != None:
+            raise ValueError('Streamed residual points need a sphere or shell domain')
+        return Stream_Sampler(N, rmin, rmax, seed=self.domain_sampler.seed)
+
+    def streamed(self, precond=False):
+        # points that are not held in memory: shards on disk or a stream
+        if precond:
+            return self.X_r_P_shards if self.X_r_P_shards != None else self.X_r_P_stream
+        return self.X_r_shards if self.X_r_shards != None else self.X_r_stream
+
+    def create_shards(self, name, N, rmin, rmax):
+        # points are streamed to disk, one directory per point set
+        sampler = self.mesh_N.get('sampler','grid')
+        config = [name, sampler, N, float(rmin), float(rmax), self.domain_sampler.seed,
+                  self.domain_sampler.lb.tolist(), self.domain_sampler.ub.tolist()]
+        if self.domain_sampler.weighted(sampler):
+            config += [self.domain_sampler.layout, self.domain_sampler.grading]
+        if 'molecule' in self.ins_domain:
+            config += [self.ins_domain[k] for k in ('surface','side') if k in self.ins_domain]
+            config += [self.get_molecule(self.ins_domain).digest()]
+        key = hashlib.sha256(json.dumps(config).encode()).hexdigest()[:32]
+        shards = Collocation_Shards(os.path.join(self.mesh_N['shards'], key))
+        if shards.size == 0:
+            blocks = self.domain_sampler.blocks(sampler, N, rmin, rmax)
+            shards.write(blocks, shard_size=self.mesh_N.get('shard_size',2**20))
+        return shards
   
 
     def plot_points_2d(self, directory, file_name):
 
-        xm,ym,zm = (self.X_r[:,0],self.X_r[:,1],self.X_r[:,2])
+        X_r = self.X_r if self.X_r != None else self.streamed().sample(100000)
+        xm,ym,zm = (X_r[:,0],X_r[:,1],X_r[:,2])
         fig, ax = plt.subplots()
         for x,y,z in self.BP:
             
@@ -203,7 +312,8 @@ class Mesh():
         fig = plt.figure()
         ax = fig.add_subplot(111, projection='3d')
 
-        xm,ym,zm = (self.X_r[:,0],self.X_r[:,1],self.X_r[:,2])
+        X_r = self.X_r if self.X_r != None else self.streamed().sample(100000)
+        xm,ym,zm = (X_r[:,0],X_r[:,1],X_r[:,2])
 
         
         for x,y,z in self.BP:
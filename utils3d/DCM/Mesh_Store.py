@@ -0,0 +1,149 @@
+import numpy as np
+import tensorflow as tf
+import hashlib
+import json
+import os
+import shutil
+import logging
+
+from DCM.Collocation_Shards import Collocation_Shards
+
+logger = logging.getLogger(__name__)
+
+
+class Mesh_Store():
+
+    version = 5
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, mesh):
+        config = {
+            'version': self.version,
+            'DTYPE': mesh.DTYPE,
+            'lb': mesh.lb,
+            'ub': mesh.ub,
+            'mesh_N': mesh.mesh_N,
+            'precondition': mesh.precondition,
+            'borders': mesh.borders,
+            'ins_domain': mesh.ins_domain,
+            # border funs and molecule files may change behind the same
+            # config, their evaluated values and atoms are hashed instead
+            'border_data': self.digest(mesh.XD_data + mesh.UD_data + mesh.XN_data + mesh.UN_data
+                                       + mesh.XK_data + mesh.UK_data + mesh.XI_data),
+            'molecules': sorted(molecule.digest() for molecule in mesh.molecules.values())
+        }
+        text = json.dumps(self.canonical(config), sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+    def digest(self, arrays):
+        h = hashlib.sha256()
+        for X in arrays:
+            h.update(np.ascontiguousarray(np.asarray(X)).tobytes())
+        return h.hexdigest()
+
+    def canonical(self, obj):
+        if isinstance(obj, dict):
+            return {str(k): self.canonical(v) for k,v in obj.items()}
+        if isinstance(obj, (list,tuple)):
+            return [self.canonical(v) for v in obj]
+        if isinstance(obj, (tf.Tensor,tf.Variable)):
+            obj = obj.numpy()
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if callable(obj):
+            # functions are identified by their code, the state they capture
+            # reaches the key through the border values
+            code = getattr(obj, '__code__', None)
+            if code is None:
+                return getattr(obj, '__qualname__', type(obj).__qualname__)
+            consts = [c for c in code.co_consts if not hasattr(c,'co_code')]
+            return [obj.__qualname__, hashlib.sha256(code.co_code).hexdigest(), repr(consts), list(code.co_names)]
+        return obj
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self.path(key), 'manifest.json'))
+
+
+    def save(self, key, mesh):
+        tmp = self.path(key) + f'.tmp{os.getpid()}'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        def write(name, X):
+            if X is None:
+                return None
+            file = name + '.npy'
+            np.save(os.path.join(tmp,file), np.asarray(X))
+            return file
+
+        def write_list(name, Xs):
+            return [write(f'{name}_{i}', X) for i,X in enumerate(Xs)]
+
+        manifest = {
+            'residual': write('residual', mesh.X_r),
+            'precondition': write('precondition', mesh.X_r_P),
+            'residual_weights': write('residual_weights', mesh.W_r),
+            'precondition_weights': write('precondition_weights', mesh.W_r_P),
+            'dirichlet': [write_list('XD', mesh.XD_data), write_list('UD', mesh.UD_data), write_list('WD', mesh.WD_data)],
+            'neumann': [write_list('XN', mesh.XN_data), write_list('UN', mesh.UN_data), mesh.derN, write_list('WN', mesh.WN_data)],
+            'neumann_normals': write_list('NN', mesh.NN_data),
+            'data_known': [write_list('XK', mesh.XK_data), write_list('UK', mesh.UK_data), write_list('WK', mesh.WK_data)],
+            'interface': [write_list('XI', mesh.XI_data), mesh.derI, write_list('WI', mesh.WI_data)],
+            'interface_normals': write_list('NI', mesh.NI_data),
+            'residual_shards': mesh.X_r_shards.directory if mesh.X_r_shards != None else None,
+            'precondition_shards': mesh.X_r_P_shards.directory if mesh.X_r_P_shards != None else None,
+            'BP': write_list('BP', [tf.concat(P, axis=1) for P in mesh.BP])
+        }
+        with open(os.path.join(tmp,'manifest.json'),'w') as f:
+            json.dump(self.canonical(manifest), f, indent=2)
+
+        if os.path.exists(self.path(key)):
+            shutil.rmtree(tmp)
+        else:
+            os.replace(tmp, self.path(key))
+        logger.info(f'Mesh stored: {key}')
+
+
+    def load(self, key, mesh):
+        path = self.path(key)
+        with open(os.path.join(path,'manifest.json')) as f:
+            manifest = json.load(f)
+
+        # a plain load, the arrays become tensors right away. Point sets too
+        # large for memory are kept as shards and streamed instead
+        def read(file):
+            if file is None:
+                return None
+            return tf.constant(np.load(os.path.join(path,file)))
+
+        def read_list(files):
+            return [read(file) for file in files]
+
+        mesh.X_r = read(manifest['residual'])
+        mesh.X_r_P = read(manifest['precondition'])
+        mesh.W_r = read(manifest['residual_weights'])
+        mesh.W_r_P = read(manifest['precondition_weights'])
+        mesh.XD_data,mesh.UD_data,mesh.WD_data = map(read_list, manifest['dirichlet'])
+        XN,UN,mesh.derN,WN = manifest['neumann']
+        mesh.XN_data,mesh.UN_data,mesh.WN_data = map(read_list, (XN,UN,WN))
+        mesh.NN_data = read_list(manifest['neumann_normals'])
+        mesh.XK_data,mesh.UK_data,mesh.WK_data = map(read_list, manifest['data_known'])
+        XI,mesh.derI,WI = manifest['interface']
+        mesh.XI_data,mesh.WI_data = map(read_list, (XI,WI))
+        mesh.NI_data = read_list(manifest['interface_normals'])
+        if manifest.get('residual_shards') != None:
+            mesh.X_r_shards = Collocation_Shards(manifest['residual_shards'])
+        if manifest.get('precondition_shards') != None:
+            mesh.X_r_P_shards = Collocation_Shards(manifest['precondition_shards'])
+        mesh.BP = [tuple(mesh.get_X(P)) for P in read_list(manifest['BP'])]
+        logger.info(f'Mesh loaded: {key}')
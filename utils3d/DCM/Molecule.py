@@ -0,0 +1,143 @@
+import numpy as np
+import os
+import hashlib
+from scipy.spatial import cKDTree
+from scipy.ndimage import distance_transform_edt
+
+from DCM.Surface_Sampler import Surface_Sampler
+
+
+class Molecule():
+
+    # Solute given by atomic spheres. Surfaces: 'vdw' is the union of the
+    # atomic spheres, 'sas' the union of the spheres inflated by the probe
+    # radius and 'ses' the volume the probe sphere cannot reach.
+
+    def __init__(self, X, r, q=None, probe=1.4, grid_spacing=0.5, block_size=2**18):
+
+        self.DTYPE='float32'
+        self.X = np.asarray(X, dtype=np.float64).reshape(-1,3)
+        self.r = np.asarray(r, dtype=np.float64).ravel()
+        self.q = np.zeros(len(self.r)) if q is None else np.asarray(q, dtype=np.float64).ravel()
+        self.probe = probe
+        # resolution of the grid used for the reentrant parts of the SES
+        self.grid_spacing = grid_spacing
+        self.block_size = block_size
+        self.tree = cKDTree(self.X)
+        self.ses_grid = None
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        ext = os.path.splitext(path)[1].lower()
+        rows = list()
+        with open(path) as f:
+            for line in f:
+                tokens = line.split()
+                if ext == '.pqr':
+                    # ... x y z charge radius, whitespace separated
+                    if len(tokens) == 0 or tokens[0] not in ('ATOM','HETATM'):
+                        continue
+                    rows.append([float(v) for v in tokens[-5:]])
+                elif ext == '.xyzr':
+                    if len(tokens) < 4:
+                        continue
+                    x,y,z,r = [float(v) for v in tokens[:4]]
+                    rows.append([x,y,z,0,r])
+                else:
+                    raise ValueError(f'Unknown molecule format: {ext}')
+        rows = np.array(rows, dtype=np.float64).reshape(-1,5)
+        return cls(rows[:,:3], rows[:,4], rows[:,3], **kwargs)
+
+    def digest(self):
+        # identifies the atoms, not the file they were read from
+        h = hashlib.sha256()
+        for a in (self.X, self.r, self.q, np.float64(self.probe)):
+            h.update(np.ascontiguousarray(a).tobytes())
+        return h.hexdigest()[:32]
+
+    def __len__(self):
+        return len(self.r)
+
+    def q_list(self):
+        # charge list in the format of PDE.q
+        return [(float(qk),Xk.tolist()) for qk,Xk in zip(self.q,self.X) if qk != 0]
+
+    def radii(self, surface='vdw'):
+        if surface == 'sas':
+            return self.r + self.probe
+        return self.r
+
+    def bounding_radius(self, surface='vdw'):
+        R = self.radii('sas' if surface == 'sas' else 'vdw')
+        return float(np.max(np.linalg.norm(self.X, axis=1) + R))
+
+
+    # Inside/outside classification
+
+    def inside(self, X, surface='vdw', margin=0):
+        X = np.asarray(X, dtype=np.float64).reshape(-1,3)
+        if surface == 'ses':
+            # contact parts are exact, reentrant gaps come from the grid
+            return self.inside(X, 'vdw') | self.inside_ses_grid(X)
+
+        R = self.radii(surface) - margin
+        # the nearest atom settles points far from every atom and points
+        # inside its own sphere, the rest check all atoms within reach
+        d,j = self.tree.query(X, k=1, distance_upper_bound=np.max(R), workers=-1)
+        out = d < R[np.minimum(j, len(R)-1)]
+        unsure = np.where(np.isfinite(d) & ~out)[0]
+        for i in range(0, len(unsure), self.block_size):
+            idx = unsure[i:i+self.block_size]
+            tree_X = cKDTree(X[idx])
+            pairs = tree_X.sparse_distance_matrix(self.tree, np.max(R), output_type='ndarray')
+            hit = pairs['v'] < R[pairs['j']]
+            out[idx[pairs['i'][hit]]] = True
+        return out
+
+    def inside_ses_grid(self, X):
+        # a point is inside the SES when it is farther than the probe radius
+        # from every probe center outside the SAS
+        if self.ses_grid is None:
+            h = self.grid_spacing
+            lo = np.min(self.X - self.r[:,None], axis=0) - 2*self.probe - h
+            hi = np.max(self.X + self.r[:,None], axis=0) + 2*self.probe + h
+            shape = np.ceil((hi - lo)/h).astype(int) + 1
+            axes = [lo[k] + h*np.arange(shape[k]) for k in range(3)]
+            G = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1,3)
+            sas = self.inside(G, 'sas').reshape(shape)
+            self.ses_grid = (lo, distance_transform_edt(sas, sampling=h) > self.probe)
+
+        lo,grid = self.ses_grid
+        idx = np.rint((X - lo)/self.grid_spacing).astype(int)
+        valid = np.all((idx >= 0) & (idx < np.array(grid.shape)), axis=1)
+        out = np.zeros(len(X), dtype=bool)
+        out[valid] = grid[tuple(idx[valid].T)]
+        return out
+
+
+    # Surface points, area weights (normalized to mean 1) and outward normals
+
+    def surface(self, N, surface='vdw', layout='fibonacci'):
+        R = self.radii('sas' if surface == 'sas' else 'vdw')
+        area = 4*np.pi*R**2
+        n_atom = np.maximum(1, np.rint(N*area/np.sum(area))).astype(int)
+        sampler = Surface_Sampler()
+
+        X,W,n = list(),list(),list()
+        for n_k in np.unique(n_atom):
+            atoms = np.where(n_atom == n_k)[0]
+            U,w = sampler.layouts[layout](n_k)
+            X.append((self.X[atoms,None,:] + R[atoms,None,None]*U[None]).reshape(-1,3))
+            W.append((R[atoms,None]**2*w[None]).ravel())
+            n.append(np.broadcast_to(U, (len(atoms),)+U.shape).reshape(-1,3))
+        X,W,n = np.concatenate(X),np.concatenate(W),np.concatenate(n)
+
+        # points buried in another sphere are not on the surface
+        exposed = ~self.inside(X, 'sas' if surface == 'sas' else 'vdw', margin=1e-6)
+        if surface == 'ses':
+            # contact surface: the probe touching the point stays outside the SAS
+            exposed &= ~self.inside(X + self.probe*n, 'sas', margin=1e-6)
+        X,W,n = X[exposed],W[exposed],n[exposed]
+
+        W = W*len(W)/np.sum(W)
+        return X.astype(self.DTYPE), W.astype(self.DTYPE), n.astype(self.DTYPE)
@@ -11,20 +11,19 @@ class Poisson(PDE_utils):
         self.epsilon = None
         self.q = None
         super().__init__()
+        self.linear = True
 
-    # Define loss of the PDE
-    def residual_loss(self,mesh,model,X):
+    # Residual of the PDE
+    def residual(self,mesh,model,X,F):
+        r = self.laplacian(mesh,model,X) - F['source']
+        return r
+
+    def residual_features(self,X):
         x,y,z = X
-        r = self.laplacian(mesh,model,X) - self.source(x,y,z)        
-        Loss_r = tf.reduce_mean(tf.square(r))
-        return Loss_r
+        return {'source': self.source(x,y,z)}
 
     def source(self,x,y,z):
-        sum = 0
-        for qk,Xk in self.q:
-            xk,yk,zk = Xk
-            deltak = tf.exp((-1/(2*self.sigma**2))*((x-xk)**2+(y-yk)**2+(z-zk)**2))
-            sum += qk*deltak
+        sum = self.charges.gaussian(x,y,z,self.sigma)
         normalizer = (1/((2*self.pi)**(3.0/2)*self.sigma**3))
         sum *= normalizer
         return (-1/self.epsilon)*sum
@@ -37,15 +36,19 @@ class Poisson(PDE_utils):
         return G
     
     def border_value(self,x,y,z,R):
-        q = 0
-        for qk,Xk in self.q:
-            xk,yk,zk = Xk
-            #r_1 = 1/((x-xk)**2+(y-yk)**2+(z-zk)**2)
-            q += qk
+        q = self.charges.total
         r = np.sqrt(x**2 + y**2 + z**2)
         return q/(4*self.pi)*(np.exp(-self.kappa*(r-R))/(self.epsilon*(1+self.kappa*R)*r))
     
-    def preconditioner(self,mesh,model,X):
+    def preconditioner(self,mesh,model,X,F):
+        x,y,z = X
+        R = mesh.stack_X(x,y,z)
+        u = model(R)
+        loss = tf.reduce_mean(tf.square(F['upred']-u))
+
+        return loss
+
+    def precondition_features(self,X):
         x,y,z = X
 
         rI = self.problem['rI']
@@ -54,13 +57,10 @@ class Poisson(PDE_utils):
         kappa = self.problem['kappa']
         q = self.q[0][0]
 
-        R = mesh.stack_X(x,y,z)
-        u = model(R)
         r = tf.sqrt(x**2+y**2+z**2)
         upred = (q/(4*self.pi)) * ( 1/(epsilon_1*r) - 1/(epsilon_1*rI) + 1/(epsilon_2*(1+kappa*rI)*rI) )
-        loss = tf.reduce_mean(tf.square(upred-u))
 
-        return loss
+        return {'upred': upred}
     
 
     def analytic(self,x,y,z):
@@ -85,23 +85,17 @@ class Helmholtz(PDE_utils):
         self.epsilon = None
         self.q = None
         super().__init__()
+        self.linear = True
 
 
-    # Define loss of the PDE
-    def residual_loss(self,mesh,model,X):
-        x,y,z = X
-        R = mesh.stack_X(x,y,z)
-        u = model(R)
-        r = self.laplacian(mesh,model,X) - self.kappa**2*u      
-        Loss_r = tf.reduce_mean(tf.square(r))
-        return Loss_r
+    # Residual of the PDE
+    def residual(self,mesh,model,X,F):
+        u,grad,lap = self.derivative_bundle(mesh,model,X,order=2)
+        r = lap - self.kappa**2*u      
+        return r
     
     def border_value(self,x,y,z,R):
-        q = 0
-        for qk,Xk in self.q:
-            xk,yk,zk = Xk
-            #r_1 = 1/((x-xk)**2+(y-yk)**2+(z-zk)**2)
-            q += qk
+        q = self.charges.total
         r = np.sqrt(x**2 + y**2 + z**2)
         return q/(4*self.pi)*(np.exp(-self.kappa*(r-R))/(self.epsilon*(1+self.kappa*R)*r))
 
@@ -112,7 +106,15 @@ class Helmholtz(PDE_utils):
         G = (1/(4*self.pi))*(-tf.exp(-self.kappa*r)/r)
         return G
 
-    def preconditioner(self,mesh,model,X):
+    def preconditioner(self,mesh,model,X,F):
+        x,y,z = X
+        R = mesh.stack_X(x,y,z)
+        u = model(R)
+        loss = tf.reduce_mean(tf.square(F['upred']-u))
+
+        return loss
+
+    def precondition_features(self,X):
         x,y,z = X
 
         rI = self.problem['rI']
@@ -121,13 +123,10 @@ class Helmholtz(PDE_utils):
         kappa = self.problem['kappa']
         q = self.q[0][0]
 
-        R = mesh.stack_X(x,y,z)
-        u = model(R)
         r = tf.sqrt(x**2+y**2+z**2)
         upred = (q/(4*self.pi)) * (tf.exp(-kappa*(r-rI))/(epsilon_2*(1+kappa*rI)*r))
-        loss = tf.reduce_mean(tf.square(upred-u))
 
-        return loss
+        return {'upred': upred}
     
 
     def analytic(self,x,y,z):
@@ -153,16 +152,18 @@ class Non_Linear(PDE_utils):
         self.epsilon = None
         self.q = None
         super().__init__()
-
-
-    # Define loss of the PDE
-    def residual_loss(self,mesh,model,X):
-        x,y,z = X
-        R = mesh.stack_X(x,y,z)
-        u = model(R)
-        r = self.laplacian(mesh,model,X) - self.kappa**2*tf.math.sinh(u)      
-        Loss_r = tf.reduce_mean(tf.square(r))
-        return Loss_r
+        self.newton = True
+
+
+    # Residual of the PDE
+    def residual(self,mesh,model,X,F):
+        u,grad,lap = self.derivative_bundle(mesh,model,X,order=2)
+        if 'u0' in F:
+            # Newton step, sinh linearized around the frozen output u0
+            u0 = F['u0']
+            return lap - self.kappa**2*(tf.math.sinh(u0) + tf.math.cosh(u0)*(u-u0))
+        r = lap - self.kappa**2*tf.math.sinh(u)      
+        return r
     
 
 
@@ -177,25 +178,29 @@ class PBE_Interface(PDE_utils):
         self.uns = unions
 
     def loss_I(self,solver,solver_ex):
+        self.clear_bundles()
         loss = 0
         for j in range(len(solver.PDE.XI_data)):
             X = solver.mesh.get_X(solver.PDE.XI_data[j])
-            x_i,y_i,z_i = X
+            r_u,r_n = self.jump(solver,solver_ex,X,j)
+            W = solver.PDE.WI_data[j]
+            loss += tf.reduce_mean(W*tf.square(r_u))
+            loss += tf.reduce_mean(W*tf.square(r_n))
+            
+        return loss
 
-            R = solver.mesh.stack_X(x_i,y_i,z_i)
-            u_1 = solver.model(R)
-            u_2 = solver_ex.model(R)
+    def jump(self,solver,solver_ex,X,j):
+        # continuity of u and of the flux on the interface points X
 
-            n_v = self.normal_vector(X)
-            du_1 = self.directional_gradient(solver.mesh,solver.model,X,n_v)
-            du_2 = self.directional_gradient(solver_ex.mesh,solver_ex.model,X,n_v)
+        # values and normal derivatives come from one tape per model
+        n_v = solver.PDE.nI_data[j]
+        du_1 = self.directional_gradient(solver.mesh,solver.model,X,n_v)
+        du_2 = self.directional_gradient(solver_ex.mesh,solver_ex.model,X,n_v)
+        u_1 = self.derivative_bundle(solver.mesh,solver.model,X,order=1)[0]
+        u_2 = self.derivative_bundle(solver_ex.mesh,solver_ex.model,X,order=1)[0]
 
-            u_prom = (u_1+u_2)/2
-            
-            loss += tf.reduce_mean(tf.square(u_1 - u_prom)) 
-            loss += tf.reduce_mean(tf.square(du_1*solver.un - du_2*solver_ex.un))
-            
-        return loss
+        u_prom = (u_1+u_2)/2
+        return u_1 - u_prom, du_1*solver.un - du_2*solver_ex.un
     
 
     def analytic(self,r):
@@ -12,25 +12,32 @@ class Poisson(PDE_utils):
         self.epsilon_G = None
         self.q = None
         super().__init__()
+        self.linear = True
 
-    # Define loss of the PDE
-    def residual_loss(self,mesh,model,X):
-        x,y,z = X
+    # Residual of the PDE
+    def residual(self,mesh,model,X,F):
         r = self.laplacian(mesh,model,X)*self.epsilon     
-        Loss_r = tf.reduce_mean(tf.square(r))
-        return Loss_r
+        return r
 
     def G_Fun(self,x,y,z):
         # epsilon es del interior
-        sum = 0
-        for qk,Xk in self.q:
-            xk,yk,zk = Xk
-            r_1 = 1/((x-xk)**2+(y-yk)**2+(z-zk)**2)
-            sum += qk*tf.sqrt(r_1)
+        sum = self.charges.coulomb(x,y,z)
         return (1/(self.epsilon_G*4*self.pi))*sum
+
+    def coulomb_term(self,x,y,z):
+        # the model learns the potential minus this term
+        return self.G_Fun(x,y,z)
     
 
-    def preconditioner(self,mesh,model,X):
+    def preconditioner(self,mesh,model,X,F):
+        x,y,z = X
+        R = mesh.stack_X(x,y,z)
+        u = model(R)
+        loss = tf.reduce_mean(tf.square(F['upred']-u))
+
+        return loss
+
+    def precondition_features(self,X):
         x,y,z = X
 
         rI = self.problem['rI']
@@ -41,13 +48,10 @@ class Poisson(PDE_utils):
 
         G = (q/(4*self.pi))*(1/(epsilon_1))
 
-        R = mesh.stack_X(x,y,z)
-        u = model(R)
         r = tf.sqrt(x**2+y**2+z**2)
         upred = (q/(4*self.pi)) * ( 1/(epsilon_1*r) - 1/(epsilon_1*rI) + 1/(epsilon_2*(1+kappa*rI)*rI) ) - G/r
-        loss = tf.reduce_mean(tf.square(upred-u))
 
-        return loss
+        return {'upred': upred}
 
 
 class Helmholtz(PDE_utils):
@@ -60,36 +64,42 @@ class Helmholtz(PDE_utils):
         self.epsilon_G = None
         self.q = None
         super().__init__()
+        self.linear = True
+
 
+    # Residual of the PDE
+    def residual(self,mesh,model,X,F):
+        u,grad,lap = self.derivative_bundle(mesh,model,X,order=2)
+        r = lap - self.kappa**2*(F['G']+u)    
+        return r
 
-    # Define loss of the PDE
-    def residual_loss(self,mesh,model,X):
+    def residual_features(self,X):
         x,y,z = X
-        R = mesh.stack_X(x,y,z)
-        u = model(R)
-        r = self.laplacian(mesh,model,X) - self.kappa**2*(self.G_Fun(x,y,z)+u)    
-        Loss_r = tf.reduce_mean(tf.square(r))
-        return Loss_r
+        return {'G': self.G_Fun(x,y,z)}
     
     def G_Fun(self,x,y,z):
         # epsilon es del interior
-        sum = 0
-        for qk,Xk in self.q:
-            xk,yk,zk = Xk
-            r_1 = 1/((x-xk)**2+(y-yk)**2+(z-zk)**2)
-            sum += qk*tf.sqrt(r_1)
+        sum = self.charges.coulomb(x,y,z)
         return (1/(self.epsilon_G*4*self.pi))*sum
+
+    def coulomb_term(self,x,y,z):
+        # the model learns the potential minus this term
+        return self.G_Fun(x,y,z)
     
     def border_value(self,x,y,z,R):
-        q = 0
-        for qk,Xk in self.q:
-            xk,yk,zk = Xk
-            #r_1 = 1/((x-xk)**2+(y-yk)**2+(z-zk)**2)
-            q += qk
+        q = self.charges.total
         r = np.sqrt(x**2 + y**2 + z**2)
         return q/(4*self.pi)*(np.exp(-self.kappa*(r-R))/(self.epsilon*(1+self.kappa*R)*r))
     
-    def preconditioner(self,mesh,model,X):
+    def preconditioner(self,mesh,model,X,F):
+        x,y,z = X
+        R = mesh.stack_X(x,y,z)
+        u = model(R)
+        loss = tf.reduce_mean(tf.square(F['upred']-u))
+
+        return loss
+
+    def precondition_features(self,X):
         x,y,z = X
 
         rI = self.problem['rI']
@@ -100,15 +110,11 @@ class Helmholtz(PDE_utils):
 
         G = (q/(4*self.pi))*(1/(epsilon_1))
 
-        R = mesh.stack_X(x,y,z)
-        u = model(R)
         r = tf.math.sqrt(x**2+y**2+z**2)
 
         upred = (q/(4*self.pi)) * (tf.math.exp(-kappa*(r-rI))/(epsilon_2*(1+kappa*rI)*r)) - G/r
 
-        loss = tf.reduce_mean(tf.square(upred-u))
-
-        return loss
+        return {'upred': upred}
     
 
     def analytic(self,x,y,z):
@@ -136,24 +142,26 @@ class Non_Linear(PDE_utils):
         self.epsilon_G = None
         self.q = None
         super().__init__()
+        self.newton = True
 
 
-    # Define loss of the PDE
-    def residual_loss(self,mesh,model,X):
+    # Residual of the PDE
+    def residual(self,mesh,model,X,F):
+        u,grad,lap = self.derivative_bundle(mesh,model,X,order=2)
+        if 'u0' in F:
+            # Newton step, sinh linearized around the frozen output u0
+            v0 = F['G']+F['u0']
+            return lap - self.kappa**2*(tf.math.sinh(v0) + tf.math.cosh(v0)*(u-F['u0']))
+        r = lap - self.kappa**2*tf.math.sinh(F['G']+u)      
+        return r
+
+    def residual_features(self,X):
         x,y,z = X
-        R = mesh.stack_X(x,y,z)
-        u = model(R)
-        r = self.laplacian(mesh,model,X) - self.kappa**2*tf.math.sinh(self.G_Fun(x,y,z)+u)      
-        Loss_r = tf.reduce_mean(tf.square(r))
-        return Loss_r
+        return {'G': self.G_Fun(x,y,z)}
     
     def G_Fun(self,x,y,z):
         # epsilon es del interior
-        sum = 0
-        for qk,Xk in self.q:
-            xk,yk,zk = Xk
-            r_1 = 1/((x-xk)**2+(y-yk)**2+(z-zk)**2)
-            sum += qk*r_1
+        sum = self.charges.inverse_square(x,y,z)
         return (-1/self.epsilon_G*4*self.pi)*sum
 
 
@@ -171,33 +179,38 @@ class PBE_Interface(PDE_utils):
         # epsilon es del interior
         #x,y,z = X
         #n_v = self.normal_vector(X)
-        sum = 0
-        for qk,Xk in self.q:
-            xk,yk,zk = Xk
-            r_1 = 1/((x-xk)**2+(y-yk)**2+(z-zk)**2)
-            sum += qk*r_1 
+        sum = self.charges.inverse_square(x,y,z)
         return (-1/self.epsilon_G*4*self.pi)*sum
 
+    def interface_features(self,X):
+        x,y,z = X
+        return {'dG_n': self.dG_n(x,y,z)}
+
     def loss_I(self,solver,solver_ex):
+        self.clear_bundles()
         loss = 0
         for j in range(len(solver.PDE.XI_data)):
             X = solver.mesh.get_X(solver.PDE.XI_data[j])
-            x_i,y_i,z_i = X
+            r_u,r_n = self.jump(solver,solver_ex,X,j)
+            W = solver.PDE.WI_data[j]
+            loss += tf.reduce_mean(W*tf.square(r_u))
+            loss += tf.reduce_mean(W*tf.square(r_n))
+            
+        return loss
 
-            R = solver.mesh.stack_X(x_i,y_i,z_i)
-            u_1 = solver.model(R)
-            u_2 = solver_ex.model(R)
+    def jump(self,solver,solver_ex,X,j):
+        # continuity of u and of the flux on the interface points X
+        F = solver.PDE.FI_data[j]
 
-            n_v = self.normal_vector(X)
-            du_1 = self.directional_gradient(solver.mesh,solver.model,X,n_v)
-            du_2 = self.directional_gradient(solver_ex.mesh,solver_ex.model,X,n_v)
+        # values and normal derivatives come from one tape per model
+        n_v = solver.PDE.nI_data[j]
+        du_1 = self.directional_gradient(solver.mesh,solver.model,X,n_v)
+        du_2 = self.directional_gradient(solver_ex.mesh,solver_ex.model,X,n_v)
+        u_1 = self.derivative_bundle(solver.mesh,solver.model,X,order=1)[0]
+        u_2 = self.derivative_bundle(solver_ex.mesh,solver_ex.model,X,order=1)[0]
 
-            u_prom = (u_1+u_2)/2
-            
-            loss += tf.reduce_mean(tf.square(u_1 - u_prom)) 
-            loss += tf.reduce_mean(tf.square((du_1*solver.un - du_2*solver_ex.un)-(solver_ex.un-solver.un)*self.dG_n(x_i,y_i,z_i)))
-            
-        return loss
+        u_prom = (u_1+u_2)/2
+        return u_1 - u_prom, (du_1*solver.un - du_2*solver_ex.un)-(solver_ex.un-solver.un)*F['dG_n']
     
 
     def analytic(self,r):
@@ -1,6 +1,8 @@
 import tensorflow as tf
 import numpy as np
 
+from DCM.Charges import Charges
+
 
 class PDE_utils():
 
@@ -8,6 +10,27 @@ class PDE_utils():
 
         self.DTYPE='float32'
         self.pi = tf.constant(np.pi, dtype=self.DTYPE)
+        # 'tape' (nested GradientTapes) or 'taylor' (single forward pass)
+        self.derivatives = 'tape'
+        self.bundles = dict()
+        self.feature_names = {False: [], True: []}
+        self.charges_packed = None
+        # treecode parameters for the charge sums, None sums directly
+        self.treecode = None
+        self.active_set = None
+        # residual affine in u, its output layer can be fitted by least squares
+        self.linear = False
+        # nonlinear residual with a linearization around a frozen u0 feature
+        self.newton = False
+    
+    # q packed as arrays, rebuilt when the charge list or the treecode
+    # parameters are replaced
+    @property
+    def charges(self):
+        packed = self.charges_packed
+        if packed is None or packed.q_list is not self.q or packed.treecode_params is not self.treecode:
+            self.charges_packed = Charges(self.q, treecode=self.treecode)
+        return self.charges_packed
     
     def set_domain(self,X):
         x,y,z = X
@@ -27,75 +50,192 @@ class PDE_utils():
         self.ub = mesh.ub
 
         self.X_r = self.mesh.data_mesh['residual']
-        self.XD_data,self.UD_data = self.mesh.data_mesh['dirichlet']
-        self.XN_data,self.UN_data,self.derN = self.mesh.data_mesh['neumann']
-        self.XI_data,self.derI = self.mesh.data_mesh['interface']
-        self.XK_data,self.UK_data = self.mesh.data_mesh['data_known']
+        self.XD_data,self.UD_data,self.WD_data = self.mesh.data_mesh['dirichlet']
+        self.XN_data,self.UN_data,self.derN,self.WN_data = self.mesh.data_mesh['neumann']
+        self.NN_data = self.mesh.data_mesh['neumann_normals']
+        self.XI_data,self.derI,self.WI_data = self.mesh.data_mesh['interface']
+        self.XK_data,self.UK_data,self.WK_data = self.mesh.data_mesh['data_known']
         self.X_r_P = self.mesh.data_mesh['precondition']
+        self.X_r_shards = self.mesh.data_mesh['residual_shards']
+        self.X_r_P_shards = self.mesh.data_mesh['precondition_shards']
 
-        self.x,self.y,self.z = self.mesh.get_X(self.X_r)
+        self.pack_borders()
+
+        self.X_r_P_F = None
+        self.nI_data = [self.mesh.get_X(NI) for NI in self.mesh.data_mesh['interface_normals']]
+        self.set_residual_points(self.X_r, self.mesh.data_mesh['residual_weights'])
         if self.X_r_P != None:
             self.xP,self.yP,self.zP = self.mesh.get_X(self.X_r_P)
-
+            self.X_r_P_F = self.with_features(self.X_r_P, precond=True, W=self.mesh.data_mesh['precondition_weights'])
+
+    def set_residual_points(self, X_r, W_r=None):
+        # the residual set of the loss, replaced by curriculum levels
+        self.X_r = X_r
+        self.X_r_F = None
+        if X_r != None:
+            self.x,self.y,self.z = self.mesh.get_X(X_r)
+            self.X_r_F = self.with_features(X_r, W=W_r)
+
+    # Newton steps: the output of the model on the residual points is frozen
+    # as one more feature column, u0, and the residual is linearized around
+    # it. The model None drops the column and the residual is nonlinear again
+    def linearize(self, model):
+        if not self.newton:
+            raise ValueError(f'{type(self).__name__} has no linearized residual')
+        if self.X_r_F is None:
+            raise ValueError('Newton steps need the residual points in memory')
+        names = self.feature_names[False]
+        if 'u0' in names:
+            j = 3 + names.index('u0')
+            self.X_r_F = tf.concat([self.X_r_F[:,:j], self.X_r_F[:,j+1:]], axis=1)
+            names.remove('u0')
+        if model != None:
+            u0 = model(self.mesh.stack_X(*self.mesh.get_X(self.X_r_F[:,:3])))
+            self.X_r_F = tf.concat([self.X_r_F, tf.cast(u0,self.DTYPE)], axis=1)
+            names.append('u0')
+        if self.active_set != None:
+            self.active_set.reset()
+
+    def linearized(self):
+        return 'u0' in self.feature_names[False]
+
+
+    # Model independent per-point features (sources, targets, Green's
+    # functions), computed once per point set and carried as extra columns
+    # next to the coordinates so batches keep them aligned with the points
+
+    def residual_features(self,X):
+        return dict()
+
+    def precondition_features(self,X):
+        return dict()
+
+    def interface_features(self,X):
+        return dict()
+
+    def adapt_interface(self,solvers):
+        for solver in solvers:
+            solver.PDE.FI_data = [self.interface_features(solver.mesh.get_X(XI)) for XI in solver.PDE.XI_data]
+
+    def with_features(self, X_data, precond=False, W=None):
+        X = self.mesh.get_X(X_data)
+        F = self.precondition_features(X) if precond else self.residual_features(X)
+        # quadrature weights of cubature sets travel as one more column
+        if W is not None:
+            F['weight'] = W
+        self.feature_names[precond] = list(F.keys())
+        if len(F) == 0:
+            return X_data
+        return tf.concat([X_data] + [tf.cast(f,self.DTYPE) for f in F.values()], axis=1)
+
+    def split_features(self, X_batch, precond=False):
+        names = self.feature_names[precond]
+        F = {name: X_batch[:,3+j:4+j] for j,name in enumerate(names)}
+        return X_batch[:,:3], F
+
+
+    def residual_loss(self,mesh,model,X,F):
+        r = self.residual(mesh,model,X,F)
+        return self.weighted_mean(tf.square(r),F)
+
+    def weighted_mean(self,v,F):
+        # weights have mean 1 over the set, so the batch mean of w*v
+        # estimates the quadrature of v
+        if 'weight' in F:
+            return tf.reduce_mean(F['weight']*v)
+        return tf.reduce_mean(v)
     
     def get_loss(self, X_batch, model):
+        self.clear_bundles()
         L = dict()
         L['r'] = 0
         L['D'] = 0
         L['N'] = 0
         L['K'] = 0
 
-        #residual
-        #X = (self.x,self.y,self.z)
+        #residual, with an active set the last column holds the point indices
+        if self.active_set != None:
+            X_batch,index = X_batch[:,:-1],X_batch[:,-1]
+        X_batch,F = self.split_features(X_batch)
         X = self.mesh.get_X(X_batch)
-        loss_r = self.residual_loss(self.mesh,model,X)
-        L['r'] += loss_r
-
-        #dirichlet 
-        loss_d = self.dirichlet_loss(self.mesh,model,self.XD_data,self.UD_data)
-        L['D'] += loss_d
+        r = self.residual(self.mesh,model,X,F)
+        if self.active_set != None:
+            self.active_set.update(index, r)
+        L['r'] += self.weighted_mean(tf.square(r),F)
 
-        #neumann
-        loss_n = self.neumann_loss(self.mesh,model,self.XN_data,self.UN_data)
-        L['N'] += loss_n
-
-        # data known
-        loss_k = self.data_known_loss(self.mesh,model,self.XK_data,self.UK_data)
-        L['K'] += loss_k    
+        #dirichlet, neumann and data known
+        L_b = self.border_loss(self.mesh,model)
+        L['D'] += L_b['D']
+        L['N'] += L_b['N']
+        L['K'] += L_b['K']
 
         return L
 
 
-    # Dirichlet
-    def dirichlet_loss(self,mesh,model,XD,UD):
-        Loss_d = 0
-        for i in range(len(XD)):
-            u_pred = model(XD[i])
-            loss = tf.reduce_mean(tf.square(UD[i] - u_pred)) 
-            Loss_d += loss
-        return Loss_d
-
-
-    def neumann_loss(self,mesh,model,XN,UN,V=None):
-        Loss_n = 0
-        for i in range(len(XN)):
-            X = mesh.get_X(XN[i])
-            grad = self.directional_gradient(mesh,model,X,self.normal_vector(X))
-            loss = tf.reduce_mean(tf.square(UN[i]-grad))
-            Loss_n += loss
-        return Loss_n
-    
-        # Dirichlet
-    def data_known_loss(self,mesh,model,XK,UK):
-        Loss_d = 0
-        for i in range(len(XK)):
-            u_pred = model(XK[i])
-            loss = tf.reduce_mean(tf.square(UK[i] - u_pred)) 
-            Loss_d += loss
-        return Loss_d
+    # Dirichlet, Neumann and data known borders packed in one tensor, each
+    # border is a segment and its type decides which loss term it feeds.
+    # Neumann borders keep the outward normals of their surface, the other
+    # types do not use theirs
+    def pack_borders(self):
+        zeros = lambda XS: [tf.zeros_like(X_b) for X_b in XS]
+        sets = [('D',self.XD_data,self.UD_data,self.WD_data,zeros(self.XD_data)),
+                ('N',self.XN_data,self.UN_data,self.WN_data,self.NN_data),
+                ('K',self.XK_data,self.UK_data,self.WK_data,zeros(self.XK_data))]
+        X,U,W,N,ids = list(),list(),list(),list(),list()
+        self.border_types = list()
+        for type_b,XS,US,WS,NS in sets:
+            for X_b,U_b,W_b,N_b in zip(XS,US,WS,NS):
+                n = X_b.shape[0]
+                X.append(tf.cast(X_b,self.DTYPE))
+                N.append(tf.cast(N_b,self.DTYPE))
+                U.append(tf.reshape(tf.cast(U_b,self.DTYPE),[n,1]))
+                W.append(tf.reshape(tf.cast(W_b,self.DTYPE),[n,1]))
+                ids.append(tf.fill([n],len(self.border_types)))
+                self.border_types.append(type_b)
+
+        if len(self.border_types) == 0:
+            self.XB_data = None
+            return
+        self.XB_data = tf.concat(X,axis=0)
+        self.UB_data = tf.concat(U,axis=0)
+        self.WB_data = tf.concat(W,axis=0)
+        self.segment_ids = tf.concat(ids,axis=0)
+        self.segment_sizes = tf.constant([[float(len(X_b))] for X_b in X], dtype=self.DTYPE)
+        types = np.array(self.border_types)
+        self.maskN = tf.gather(tf.constant(types == 'N'), self.segment_ids)[:,None]
+        self.segment_masks = {t: tf.constant((types == t)[:,None], dtype=self.DTYPE) for t in ['D','N','K']}
+        self.XB = self.mesh.get_X(self.XB_data)
+        self.nB = self.mesh.get_X(tf.concat(N,axis=0))
+
+    def border_residual(self,mesh,model):
+        # the gradient is only needed when there are Neumann borders
+        if 'N' in self.border_types:
+            u,grad,_ = self.derivative_bundle(mesh,model,self.XB,order=1)
+            du = 0
+            for j in range(3):
+                du += self.nB[j]*grad[j]
+            pred = tf.where(self.maskN, du, u)
+        else:
+            pred = self.derivative_bundle(mesh,model,self.XB,order=0)[0]
+        return pred - self.UB_data
+
+    def border_loss(self,mesh,model):
+        L = {'D': 0, 'N': 0, 'K': 0}
+        if self.XB_data is None:
+            return L
+
+        # segment sums compile with XLA, segment means do not
+        r = self.border_residual(mesh,model)
+        loss = tf.math.unsorted_segment_sum(self.WB_data*tf.square(r), self.segment_ids, len(self.border_types))
+        loss = loss/self.segment_sizes
+        for t in L:
+            if t in self.border_types:
+                L[t] = tf.reduce_sum(loss*self.segment_masks[t])
+        return L
 
 
     def get_loss_preconditioner(self, X_batch, model):
+        self.clear_bundles()
         L = dict()
         L['r'] = 0
         L['D'] = 0
@@ -104,8 +244,9 @@ class PDE_utils():
         L['K'] = 0
 
         #residual
+        X_batch,F = self.split_features(X_batch, precond=True)
         X = self.mesh.get_X(X_batch)
-        loss_r = self.preconditioner(self.mesh,model,X)
+        loss_r = self.preconditioner(self.mesh,model,X,F)
         L['r'] += loss_r
 
         return L
@@ -144,8 +285,52 @@ class PDE_utils():
 
     # Differential operators
 
-    def laplacian(self,mesh,model,X):
+    def taylor_mode(self,model):
+        # loaded SavedModels lose the python methods, they fall back to tapes
+        return self.derivatives == 'taylor' and hasattr(model,'call_laplacian')
+
+    # Derivative bundle: u, grad u and laplacian of a model on a point set,
+    # evaluated once per step and shared by every loss term on those points.
+    # order 0 gives u, 1 adds the gradient and 2 adds the laplacian.
+
+    def clear_bundles(self):
+        self.bundles = dict()
+
+    def derivative_bundle(self,mesh,model,X,order=2):
+        key = (id(model),id(X[0]))
+        if key in self.bundles:
+            X_cached,order_cached,bundle = self.bundles[key]
+            if order_cached >= order:
+                return bundle
+        bundle = self.evaluate_bundle(mesh,model,X,order)
+        # the points are kept so their id is not reused during the step
+        self.bundles[key] = (X,order,bundle)
+        return bundle
+
+    def set_bundle(self,model,X,bundle,order=2):
+        # a precomputed bundle, used by the following loss terms on X
+        self.bundles[(id(model),id(X[0]))] = (X,order,bundle)
+
+    def evaluate_bundle(self,mesh,model,X,order):
         x,y,z = X
+        if order == 0:
+            return model(mesh.stack_X(x,y,z)), None, None
+        if self.taylor_mode(model):
+            u,grad,lap = model.call_laplacian(mesh.stack_X(x,y,z))
+            return u, tuple(tf.split(grad,3,axis=1)), lap
+        if order == 1:
+            with tf.GradientTape(persistent=True,watch_accessed_variables=False) as tape:
+                tape.watch(x)
+                tape.watch(y)
+                tape.watch(z)
+                R = mesh.stack_X(x,y,z)
+                u = model(R)
+            u_x = tape.gradient(u,x)
+            u_y = tape.gradient(u,y)
+            u_z = tape.gradient(u,z)
+            del tape
+            return u, (u_x,u_y,u_z), None
+
         with tf.GradientTape(persistent=True) as tape:
             tape.watch(x)
             tape.watch(y)
@@ -160,22 +345,15 @@ class PDE_utils():
         u_zz = tape.gradient(u_z,z)
         del tape
 
-        return u_xx + u_yy + u_zz
+        return u, (u_x,u_y,u_z), u_xx + u_yy + u_zz
 
-    def gradient(self,mesh,model,X):
-        x,y,z = X
-        with tf.GradientTape(persistent=True,watch_accessed_variables=False) as tape:
-            tape.watch(x)
-            tape.watch(y)
-            tape.watch(z)
-            R = mesh.stack_X(x,y,z)
-            u = model(R)
-        u_x = tape.gradient(u,x)
-        u_y = tape.gradient(u,y)
-        u_z = tape.gradient(u,z)
-        del tape
+    def laplacian(self,mesh,model,X):
+        u,grad,lap = self.derivative_bundle(mesh,model,X,order=2)
+        return lap
 
-        return (u_x,u_y,u_z)
+    def gradient(self,mesh,model,X):
+        u,grad,lap = self.derivative_bundle(mesh,model,X,order=1)
+        return grad
     
     def directional_gradient(self,mesh,model,X,n):
         gradient = self.gradient(mesh,model,X)
@@ -183,4 +361,4 @@ class PDE_utils():
         for j in range(3):
             dir_deriv += n[j]*gradient[j]
 
-        return dir_deriv
\ No newline at end of file
+        return dir_deriv
@@ -41,13 +41,14 @@ class View_results():
             fig = plt.figure(figsize=(7, 5))
             ax = fig.add_subplot(111)
 
-        ax.semilogy(range(len(self.NN.loss_hist)), self.NN.loss_hist, 'k-', label='Loss')
+        iters = self.NN.history['iter']
+        ax.semilogy(iters, self.NN.loss_hist, 'k-', label='Loss')
 
         if flag:
-            ax.semilogy(range(len(self.NN.loss_r)), self.NN.loss_r, 'r-', label='Loss_r')
-            ax.semilogy(range(len(self.NN.loss_bD)), self.NN.loss_bD, 'b-', label='Loss_bD')
-            ax.semilogy(range(len(self.NN.loss_bN)), self.NN.loss_bN, 'g-', label='Loss_bN')
-            ax.semilogy(range(len(self.NN.loss_bK)), self.NN.loss_bK, 'm-', label='Loss_bK')
+            ax.semilogy(iters, self.NN.loss_r, 'r-', label='Loss_r')
+            ax.semilogy(iters, self.NN.loss_bD, 'b-', label='Loss_bD')
+            ax.semilogy(iters, self.NN.loss_bN, 'g-', label='Loss_bN')
+            ax.semilogy(iters, self.NN.loss_bK, 'm-', label='Loss_bK')
 
         ax.legend()
         ax.set_xlabel('$n: iterations$')
@@ -63,9 +64,10 @@ class View_results():
             logger.info(f'Loss history Plot saved: {path}')
 
             if self.data:
-                d = {'Residual': list(map(lambda tensor: tensor.numpy(), self.NN.loss_r)),
-                     'Dirichlet': list(map(lambda tensor: tensor.numpy(), self.NN.loss_bD)),
-                     'Neumann': list(map(lambda tensor: tensor.numpy(), self.NN.loss_bN))
+                H = self.NN.history.to_numpy()
+                d = {'Residual': H['r'],
+                     'Dirichlet': H['D'],
+                     'Neumann': H['N']
                      }
                 df = pd.DataFrame(d)
                 df.to_excel(self.Excel_writer, sheet_name='Losses', index=False)
@@ -210,6 +212,16 @@ class View_results():
         plt.colorbar();
 
 
+    def evaluate_potential(self,X):
+        # Coulomb regularized models learn the potential minus the Coulomb
+        # term, which is added back here (through the treecode for large
+        # molecules)
+        U = self.model(X)
+        if hasattr(self.NN.PDE,'coulomb_term'):
+            x,y,z = self.mesh.get_X(X)
+            U = U + self.NN.PDE.coulomb_term(x,y,z)
+        return U
+
     def evaluate_u_point(self,X):
         X_input = tf.constant([X])
         U_output = self.model(X_input)
@@ -307,16 +319,17 @@ class View_results_X():
         if not ax:
             fig = plt.figure(figsize=(7,5))
             ax = fig.add_subplot(111)
-        ax.semilogy(range(len(self.XPINN.loss_hist)), self.XPINN.loss_hist,'k-',label='Loss')
+        iters = self.XPINN.history['iter']
+        ax.semilogy(iters, self.XPINN.loss_hist,'k-',label='Loss')
         if flag: 
             iter = 1
             c = [['r','b','g'],['salmon','royalblue','springgreen']]
             for NN in self.NN:
-                ax.semilogy(range(len(NN.loss_r)), NN.loss_r,c[iter-1][0],label='Loss_r_NN_'+str(iter))
-                ax.semilogy(range(len(NN.loss_bD)), NN.loss_bD,c[iter-1][1],label='Loss_bD_NN_'+str(iter))
-                ax.semilogy(range(len(NN.loss_bN)), NN.loss_bN,c[iter-1][2],label='Loss_bN_NN_'+str(iter))
+                ax.semilogy(iters, NN.loss_r,c[iter-1][0],label='Loss_r_NN_'+str(iter))
+                ax.semilogy(iters, NN.loss_bD,c[iter-1][1],label='Loss_bD_NN_'+str(iter))
+                ax.semilogy(iters, NN.loss_bN,c[iter-1][2],label='Loss_bN_NN_'+str(iter))
                 iter += 1
-            ax.semilogy(range(len(NN.loss_bI)), NN.loss_bI,'m',label='Loss_bI')
+            ax.semilogy(iters, NN.loss_bI,'m',label='Loss_bI')
 
         ax.legend()
         ax.set_xlabel('$n: iterations$')
@@ -332,19 +345,21 @@ class View_results_X():
             logger.info(f'Loss history Plot saved: {path}')
 
             if self.data:
-                d = {'Residual_1': list(map(lambda tensor: tensor.numpy(), self.NN[0].loss_r)),
-                     'Residual_2': list(map(lambda tensor: tensor.numpy(), self.NN[1].loss_r)),
-                     'Dirichlet_1': list(map(lambda tensor: tensor.numpy(), self.NN[0].loss_bD)),
-                     'Dirichlet_2': list(map(lambda tensor: tensor.numpy(), self.NN[1].loss_bD)),
-                     'Neumann_1': list(map(lambda tensor: tensor.numpy(), self.NN[0].loss_bN)),
-                     'Neumann_2': list(map(lambda tensor: tensor.numpy(), self.NN[1].loss_bN)),
-                     'Interface': list(map(lambda tensor: tensor.numpy(), self.NN[0].loss_bN))
+                H1 = self.NN[0].history.to_numpy()
+                H2 = self.NN[1].history.to_numpy()
+                d = {'Residual_1': H1['r'],
+                     'Residual_2': H2['r'],
+                     'Dirichlet_1': H1['D'],
+                     'Dirichlet_2': H2['D'],
+                     'Neumann_1': H1['N'],
+                     'Neumann_2': H2['N'],
+                     'Interface': H1['I']
                      }
                 df = pd.DataFrame(d)
                 df.to_excel(self.Excel_writer, sheet_name='Losses', index=False)
 
 
-    def plot_u_plane(self,N=200, theta=np.pi/2, phi=0 ):
+    def plot_u_plane(self,N=200, theta=np.pi/2, phi=0, total=False):
         fig, ax = plt.subplots()
         labels = ['Inside', 'Outside']
         colr = ['r','b']
@@ -361,7 +376,7 @@ class View_results_X():
             z = r*np.cos(theta)
 
             X = tf.concat([x, y, z], axis=1)
-            U = post_obj.model(X)
+            U = post_obj.evaluate_potential(X) if total else post_obj.model(X)
 
             if self.data:
                 d = {'x': x[:,0],
@@ -387,13 +402,13 @@ class View_results_X():
         ax.legend()
 
         if self.save:
-            path = 'solution.png'
+            path = 'potential.png' if total else 'solution.png'
             path_save = os.path.join(self.directory,path)
             fig.savefig(path_save)
             logger.info(f'Solution Plot saved: {path}')
 
             if self.data:
-                df.to_excel(self.Excel_writer, sheet_name='Solution', index=False)
+                df.to_excel(self.Excel_writer, sheet_name='Potential' if total else 'Solution', index=False)
 
 
     def plot_u_domain_contour(self, N=100):
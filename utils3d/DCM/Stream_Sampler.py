@@ -0,0 +1,45 @@
+import numpy as np
+import tensorflow as tf
+
+
+class Stream_Sampler():
+
+    # Residual points drawn fresh for every batch instead of a stored set.
+    # Points are uniform in the shell rmin < r < rmax, generated by a
+    # stateless RNG from the dataset seed and the batch index, so the same
+    # seed gives the same stream and every epoch sees new points. Same
+    # dataset interface as Collocation_Shards.
+
+    def __init__(self, N, rmin, rmax, seed=1234):
+
+        self.DTYPE='float32'
+        self.size = N
+        self.columns = 3
+        self.rmin = max(rmin, 0)
+        self.rmax = rmax
+        self.seed = seed
+
+    def points(self, n, seed):
+        U = tf.random.stateless_uniform([n,3], seed=seed, dtype=self.DTYPE)
+        r = tf.pow(self.rmin**3 + U[:,0]*(self.rmax**3 - self.rmin**3), 1/3)
+        z = 1 - 2*U[:,1]
+        rho = tf.sqrt(tf.maximum(1 - z**2, 0))
+        phi = 2*np.pi*U[:,2]
+        return tf.stack([r*rho*tf.cos(phi), r*rho*tf.sin(phi), r*z], axis=1)
+
+    def sample(self, N):
+        return self.points(N, tf.constant([self.seed,-1], dtype=tf.int64))
+
+    def dataset(self, batch_size, drop_remainder=False, seed=None):
+        # one epoch, batches are always full. Batch i draws with (seed, i+1),
+        # epochs of a longer pipeline pass their own seed
+        seed = tf.cast(self.seed if seed is None else seed, tf.int64)
+
+        def draw(i):
+            return self.points(batch_size, tf.stack([seed, i+1]))
+
+        batches = tf.data.Dataset.range(self.batches(batch_size)).map(draw)
+        return batches.prefetch(tf.data.AUTOTUNE)
+
+    def batches(self, batch_size, drop_remainder=False):
+        return max(1, self.size//batch_size)
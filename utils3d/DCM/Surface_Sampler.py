@@ -0,0 +1,94 @@
+import numpy as np
+
+
+class Surface_Sampler():
+
+    def __init__(self):
+
+        self.DTYPE='float32'
+        self.layouts = {
+            'fibonacci': self.fibonacci,
+            'icosphere': self.icosphere,
+            'gauss_product': self.gauss_product
+        }
+
+    # Points on the sphere of radius R, weights normalized to mean 1. Only
+    # fibonacci gives exactly N points: icosphere gives the vertex count
+    # 10*4^k+2 closest to N and gauss_product 2*round(sqrt(N/2))^2 points
+    def sample(self, R, N, layout='fibonacci', center=(0,0,0)):
+        if layout not in self.layouts:
+            raise ValueError(f'Unknown surface layout: {layout}')
+        X,w = self.layouts[layout](N)
+        X = R*X + np.array(center, dtype=np.float64)
+        w = w*len(w)/np.sum(w)
+        return X.astype(self.DTYPE), w.astype(self.DTYPE)
+
+
+    # Unit sphere layouts, weights sum to 4*pi
+
+    def fibonacci(self,N):
+        i = np.arange(N, dtype=np.float64) + 0.5
+        z = 1 - 2*i/N
+        rho = np.sqrt(1 - z**2)
+        golden_angle = np.pi*(3 - np.sqrt(5))
+        phi = golden_angle*i
+        X = np.stack([rho*np.cos(phi), rho*np.sin(phi), z], axis=1)
+        w = np.full(N, 4*np.pi/N)
+        return X,w
+
+    def icosphere(self,N):
+        # subdivision level with the vertex count (10*4^k+2) closest to N
+        level = 0
+        while abs(10*4**(level+1)+2 - N) < abs(10*4**level+2 - N):
+            level += 1
+
+        t = (1 + np.sqrt(5))/2
+        V = [[-1,t,0],[1,t,0],[-1,-t,0],[1,-t,0],
+             [0,-1,t],[0,1,t],[0,-1,-t],[0,1,-t],
+             [t,0,-1],[t,0,1],[-t,0,-1],[-t,0,1]]
+        F = [[0,11,5],[0,5,1],[0,1,7],[0,7,10],[0,10,11],
+             [1,5,9],[5,11,4],[11,10,2],[10,7,6],[7,1,8],
+             [3,9,4],[3,4,2],[3,2,6],[3,6,8],[3,8,9],
+             [4,9,5],[2,4,11],[6,2,10],[8,6,7],[9,8,1]]
+        V = [np.array(v, dtype=np.float64)/np.linalg.norm(v) for v in V]
+
+        for _ in range(level):
+            midpoints = dict()
+            def midpoint(a,b):
+                key = (min(a,b),max(a,b))
+                if key not in midpoints:
+                    m = V[a] + V[b]
+                    V.append(m/np.linalg.norm(m))
+                    midpoints[key] = len(V) - 1
+                return midpoints[key]
+            F_new = list()
+            for a,b,c in F:
+                ab,bc,ca = midpoint(a,b),midpoint(b,c),midpoint(c,a)
+                F_new += [[a,ab,ca],[b,bc,ab],[c,ca,bc],[ab,bc,ca]]
+            F = F_new
+
+        X = np.array(V)
+        F = np.array(F)
+
+        # vertex weight: a third of the spherical excess of each adjacent face
+        a,b,c = X[F[:,0]],X[F[:,1]],X[F[:,2]]
+        num = np.abs(np.einsum('ij,ij->i', a, np.cross(b,c)))
+        den = 1 + np.einsum('ij,ij->i',a,b) + np.einsum('ij,ij->i',b,c) + np.einsum('ij,ij->i',c,a)
+        area = 2*np.arctan2(num,den)
+        w = np.zeros(len(X))
+        for j in range(3):
+            np.add.at(w, F[:,j], area/3)
+        return X,w
+
+    def gauss_product(self,N):
+        # Gauss-Legendre in cos(theta) times trapezoid in phi,
+        # exact for spherical harmonics up to degree 2*N_t-1
+        N_t = max(1, int(round(np.sqrt(N/2))))
+        N_p = 2*N_t
+        z,w_z = np.polynomial.legendre.leggauss(N_t)
+        phi = 2*np.pi*(np.arange(N_p) + 0.5)/N_p
+        Z,Phi = np.meshgrid(z, phi, indexing='ij')
+        W = np.repeat(w_z, N_p)*(2*np.pi/N_p)
+        rho = np.sqrt(1 - Z**2)
+        X = np.stack([(rho*np.cos(Phi)).flatten(), (rho*np.sin(Phi)).flatten(), Z.flatten()], axis=1)
+        return X,W
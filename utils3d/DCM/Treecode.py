@@ -0,0 +1,157 @@
+import numpy as np
+
+
+def pairwise_kernel(T, S, kind='coulomb', kappa=0, normals=None):
+    # G(t,s) for targets T (N,3) and sources S (M,3), or n_t.grad_t G(t,s)
+    # when target normals are given. Distances come from matmuls, pairs at
+    # zero distance contribute nothing.
+    d2 = np.sum(T**2, axis=1)[:,None] + np.sum(S**2, axis=1)[None,:] - 2*T@S.T
+    np.maximum(d2, 0, out=d2)
+    zero = d2 == 0
+    d2[zero] = 1
+    r = np.sqrt(d2)
+
+    if normals is None:
+        if kind == 'coulomb':
+            K = 1/r
+        elif kind == 'inverse_square':
+            K = 1/d2
+        elif kind == 'screened':
+            K = np.exp(-kappa*r)/r
+    else:
+        # (t-s).n_t
+        dn = np.sum(T*normals, axis=1)[:,None] - normals@S.T
+        if kind == 'coulomb':
+            K = -dn/(d2*r)
+        elif kind == 'inverse_square':
+            K = -2*dn/(d2*d2)
+        elif kind == 'screened':
+            K = -dn*np.exp(-kappa*r)*(1+kappa*r)/(d2*r)
+    K[zero] = 0
+    return K
+
+
+class Treecode():
+
+    # Barycentric Lagrange treecode. Sources are sorted into an octree, each
+    # cluster gets proxy charges at tensor Chebyshev points of the given
+    # degree, and a batch of targets interacts with a cluster through its
+    # proxies when (r_batch + r_cluster) < theta*distance.
+
+    def __init__(self, X, q, theta=0.7, degree=6, leaf_size=1000, batch_size=500):
+
+        self.theta = theta
+        self.degree = degree
+        self.leaf_size = leaf_size
+        self.batch_size = batch_size
+
+        X = np.asarray(X, dtype=np.float64).reshape(-1,3)
+        q = np.asarray(q, dtype=np.float64).ravel()
+        order,self.nodes = self.build(X, leaf_size)
+        self.X = X[order]
+        self.q = q[order]
+        self.proxies = dict()
+
+        j = np.arange(degree+1)
+        self.cheb = np.cos(j*np.pi/degree)
+        self.weights = (-1.0)**j
+        self.weights[[0,-1]] *= 0.5
+
+    def build(self, X, leaf_size):
+        order = np.arange(len(X))
+        nodes = list()
+
+        def split(start, end):
+            P = X[order[start:end]]
+            lo,hi = P.min(axis=0), P.max(axis=0)
+            center = (lo + hi)/2
+            node = {'start': start, 'end': end, 'lo': lo, 'hi': hi, 'center': center,
+                    'radius': np.linalg.norm(hi - lo)/2, 'children': list()}
+            k = len(nodes)
+            nodes.append(node)
+            if end - start <= leaf_size or node['radius'] == 0:
+                return k
+
+            octant = (P[:,0] > center[0]) + 2*(P[:,1] > center[1]) + 4*(P[:,2] > center[2])
+            sort = np.argsort(octant, kind='stable')
+            order[start:end] = order[start:end][sort]
+            counts = np.bincount(octant, minlength=8)
+            i = start
+            for count in counts:
+                if count > 0:
+                    node['children'].append(split(i, i + count))
+                i += count
+            return k
+
+        if len(X) > 0:
+            split(0, len(X))
+        return order, nodes
+
+    def lagrange(self, x, lo, hi):
+        # barycentric Lagrange basis on the Chebyshev points of [lo,hi]
+        h = max((hi - lo)/2, 1e-12)
+        s = (lo + hi)/2 + h*self.cheb
+        d = x[:,None] - s[None,:]
+        exact = d == 0
+        d[exact] = 1
+        L = self.weights/d
+        L /= np.sum(L, axis=1, keepdims=True)
+        rows = np.any(exact, axis=1)
+        L[rows] = exact[rows]
+        return L, s
+
+    def proxy(self, i):
+        if i not in self.proxies:
+            node = self.nodes[i]
+            X = self.X[node['start']:node['end']]
+            q = self.q[node['start']:node['end']]
+            Lx,sx = self.lagrange(X[:,0], node['lo'][0], node['hi'][0])
+            Ly,sy = self.lagrange(X[:,1], node['lo'][1], node['hi'][1])
+            Lz,sz = self.lagrange(X[:,2], node['lo'][2], node['hi'][2])
+            q_proxy = np.einsum('k,ka,kb,kc->abc', q, Lx, Ly, Lz).ravel()
+            S = np.stack(np.meshgrid(sx, sy, sz, indexing='ij'), axis=-1).reshape(-1,3)
+            self.proxies[i] = (S, q_proxy)
+        return self.proxies[i]
+
+    def interactions(self, center, radius):
+        n_proxy = (self.degree + 1)**3
+        direct,far = list(),list()
+        stack = [0] if len(self.nodes) > 0 else []
+        while stack:
+            i = stack.pop()
+            node = self.nodes[i]
+            distance = np.linalg.norm(center - node['center'])
+            size = node['end'] - node['start']
+            if radius + node['radius'] < self.theta*distance and size > n_proxy:
+                far.append(i)
+            elif len(node['children']) == 0 or size <= n_proxy:
+                direct.append(i)
+            else:
+                stack.extend(node['children'])
+        return direct, far
+
+    def evaluate(self, T, kind='coulomb', kappa=0, normals=None):
+        T = np.asarray(T, dtype=np.float64).reshape(-1,3)
+        out = np.zeros(len(T))
+        if len(T) == 0:
+            return out
+        order,batches = self.build(T, self.batch_size)
+
+        for batch in batches:
+            if len(batch['children']) > 0:
+                continue
+            idx = order[batch['start']:batch['end']]
+            T_b = T[idx]
+            n_b = normals[idx] if normals is not None else None
+            direct,far = self.interactions(batch['center'], batch['radius'])
+
+            value = np.zeros(len(idx))
+            if direct:
+                rows = np.concatenate([np.arange(self.nodes[i]['start'], self.nodes[i]['end']) for i in direct])
+                value += pairwise_kernel(T_b, self.X[rows], kind, kappa, n_b)@self.q[rows]
+            if far:
+                S = np.concatenate([self.proxy(i)[0] for i in far])
+                q_proxy = np.concatenate([self.proxy(i)[1] for i in far])
+                value += pairwise_kernel(T_b, S, kind, kappa, n_b)@q_proxy
+            out[idx] = value
+        return out
@@ -0,0 +1,135 @@
+import numpy as np
+import tensorflow as tf
+import threading
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def optimizer_variables(optimizer):
+    variables = optimizer.variables
+    return list(variables() if callable(variables) else variables)
+
+
+def build_optimizer(optimizer, var_list):
+    # create slots before restoring, as the first apply_gradients would
+    if hasattr(optimizer, '_create_all_weights'):
+        optimizer._create_all_weights(var_list)
+    else:
+        optimizer.build(var_list)
+
+
+class Checkpoint_Manager():
+
+    def __init__(self, directory, models, optimizers, histories, max_to_keep=3, states=()):
+
+        self.directory = directory
+        self.models = models
+        self.optimizers = optimizers
+        self.histories = histories
+        # objects with state() and load_state(arrays), e.g. resampled
+        # residual points, saved next to the histories
+        self.states = list(states)
+        self.arrays = None
+        self.max_to_keep = max_to_keep
+
+        self.shadow = None
+        self.thread = None
+        self.iter = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.precondition = tf.Variable(False, trainable=False)
+
+    def variables(self):
+        weights = [model.trainable_variables for model in self.models]
+        slots = [optimizer_variables(optimizer) for optimizer in self.optimizers]
+        return weights, slots
+
+    def build(self):
+        # copies of weights and optimizer state, written by the background
+        # thread while training keeps updating the originals
+        weights, slots = self.variables()
+        copy = lambda vs: [tf.Variable(v, trainable=False) for v in vs]
+        self.shadow = {
+            'weights': [copy(vs) for vs in weights],
+            'slots': [copy(vs) for vs in slots]
+        }
+        self.checkpoint = tf.train.Checkpoint(weights=self.shadow['weights'],
+                                              slots=self.shadow['slots'],
+                                              iter=self.iter,
+                                              precondition=self.precondition)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, self.directory,
+                                                  max_to_keep=self.max_to_keep)
+
+    def save(self, iter, precondition=False):
+        self.wait()
+        if self.shadow is None:
+            self.build()
+
+        weights, slots = self.variables()
+        for shadows,vs in zip(self.shadow['weights']+self.shadow['slots'], weights+slots):
+            for shadow,v in zip(shadows,vs):
+                shadow.assign(v)
+        self.iter.assign(iter)
+        self.precondition.assign(precondition)
+        # rows already written are never modified, views are enough
+        histories = [history.state() for history in self.histories]
+        states = [state.state() for state in self.states]
+
+        self.thread = threading.Thread(target=self.write, args=(iter,histories,states))
+        self.thread.start()
+
+    def write(self, iter, histories, states):
+        path = self.manager.save(checkpoint_number=iter)
+        arrays = dict()
+        for i,(data,count) in enumerate(histories):
+            arrays[f'data_{i}'] = data
+            arrays[f'count_{i}'] = count
+        for i,state in enumerate(states):
+            for name,value in state.items():
+                arrays[f'state_{i}_{name}'] = value
+        # the history appears complete or not at all, a checkpoint without
+        # one (killed in between) is skipped by restore
+        np.savez(path + '.history.tmp.npz', **arrays)
+        os.replace(path + '.history.tmp.npz', path + '.history.npz')
+
+        kept = set(self.manager.checkpoints)
+        for file in os.listdir(self.directory):
+            for suffix in ['.history.npz', '.history.tmp.npz']:
+                if file.endswith(suffix) and os.path.join(self.directory, file[:-len(suffix)]) not in kept:
+                    os.remove(os.path.join(self.directory,file))
+        logger.info(f'Checkpoint saved: {path}')
+
+    def restore(self, path=None):
+        if self.shadow is None:
+            self.build()
+        if path is None:
+            # newest checkpoint whose history was written
+            complete = [p for p in self.manager.checkpoints if os.path.exists(p + '.history.npz')]
+            path = complete[-1] if len(complete) > 0 else None
+        if path is None:
+            raise FileNotFoundError(f'No checkpoint found in {self.directory}')
+        self.checkpoint.restore(path).assert_existing_objects_matched()
+
+        weights, slots = self.variables()
+        for shadows,vs in zip(self.shadow['weights']+self.shadow['slots'], weights+slots):
+            for shadow,v in zip(shadows,vs):
+                v.assign(shadow)
+
+        arrays = np.load(path + '.history.npz')
+        for i,history in enumerate(self.histories):
+            history.load_state(arrays[f'data_{i}'], arrays[f'count_{i}'])
+        self.arrays = arrays
+        logger.info(f'Checkpoint restored: {path}')
+        return int(self.iter.numpy()), bool(self.precondition.numpy())
+
+    def load_states(self):
+        # separate from restore, the caller sets up the residual points of
+        # the restored iteration first
+        for i,state in enumerate(self.states):
+            prefix = f'state_{i}_'
+            state.load_state({name[len(prefix):]: self.arrays[name] for name in self.arrays.files if name.startswith(prefix)})
+
+    def wait(self):
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,29 @@
+import tensorflow as tf
+
+
+class Epoch_Batches():
+
+    # Minibatches of every epoch from one dataset, built once per point set.
+    # `epoch` maps an epoch, numbered by the iteration it trains, to the
+    # dataset of its N batches. The shuffle only depends on that number, so
+    # a dataset built later (another phase, a resumed run) gives the same
+    # batches. The iterator is kept across epochs and the prefetch reads
+    # the next epoch while the current one trains.
+
+    def __init__(self, epoch, N, start, sources, layout):
+
+        self.N = N
+        self.sources = sources
+        self.layout = layout
+        self.next_epoch = start
+        epochs = tf.data.Dataset.counter(start).flat_map(epoch)
+        self.iterator = iter(epochs.prefetch(tf.data.AUTOTUNE))
+
+    def valid(self, sources, layout, iter):
+        # the same point sets (by identity) and batches, at the next epoch
+        return (self.next_epoch == iter and self.layout == layout
+                and len(sources) == len(self.sources)
+                and all(a is b for a,b in zip(sources,self.sources)))
+
+    def advance(self, K):
+        self.next_epoch += K
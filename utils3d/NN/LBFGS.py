@@ -0,0 +1,129 @@
+import numpy as np
+import tensorflow as tf
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LBFGS():
+
+    # Full batch L-BFGS on the trainable variables seen as one flat vector.
+    # The last m curvature pairs are kept in a ring buffer of variables and
+    # one iteration (two loop recursion and a backtracking Armijo line
+    # search) is a single compiled call. loss_fn(X) returns the loss and a
+    # structure of loss terms that is handed back with it.
+
+    def __init__(self, loss_fn, var_list, m=50, c1=1e-4, max_ls=20, dtype='float32'):
+
+        self.DTYPE = dtype
+        self.loss_fn = loss_fn
+        self.var_list = list(var_list)
+        self.shapes = [v.shape for v in self.var_list]
+        self.sizes = [int(np.prod(s)) for s in self.shapes]
+        n = sum(self.sizes)
+        self.m = m
+        self.c1 = c1
+        self.max_ls = max_ls
+
+        self.S = tf.Variable(tf.zeros([m,n], self.DTYPE), trainable=False)
+        self.Y = tf.Variable(tf.zeros([m,n], self.DTYPE), trainable=False)
+        self.rho = tf.Variable(tf.zeros([m], self.DTYPE), trainable=False)
+        # pairs stored so far, the newest one sits at (k-1) % m
+        self.k = tf.Variable(0, dtype=tf.int32, trainable=False)
+        self.f = tf.Variable(np.inf, dtype=self.DTYPE, trainable=False)
+        self.g = tf.Variable(tf.zeros([n], self.DTYPE), trainable=False)
+        self.steps = dict()
+
+    def flat(self, tensors):
+        return tf.concat([tf.reshape(t,[-1]) for t in tensors], axis=0)
+
+    def assign(self, x):
+        for v,part,shape in zip(self.var_list, tf.split(x, self.sizes), self.shapes):
+            v.assign(tf.reshape(part, shape))
+
+    def value_and_grad(self, X):
+        with tf.GradientTape() as tape:
+            loss,L = self.loss_fn(X)
+        g = tape.gradient(loss, self.var_list)
+        g = [tf.zeros_like(v) if gi is None else gi for v,gi in zip(self.var_list,g)]
+        L = tf.nest.map_structure(lambda t: tf.cast(t,self.DTYPE), L)
+        return tf.cast(loss,self.DTYPE), L, self.flat(g)
+
+    def direction(self, g):
+        # two loop recursion, newest pair first
+        k = tf.minimum(self.k, self.m)
+        q = g
+        alphas = tf.TensorArray(self.DTYPE, size=self.m)
+        for i in tf.range(k):
+            j = (self.k - 1 - i) % self.m
+            a = self.rho[j]*tf.tensordot(self.S[j], q, 1)
+            q -= a*self.Y[j]
+            alphas = alphas.write(i, a)
+
+        j = (self.k - 1) % self.m
+        gamma = tf.cond(k > 0,
+                        lambda: tf.tensordot(self.S[j],self.Y[j],1)/tf.tensordot(self.Y[j],self.Y[j],1),
+                        lambda: tf.constant(1, self.DTYPE))
+        r = gamma*q
+        for i in tf.range(k-1, -1, -1):
+            j = (self.k - 1 - i) % self.m
+            b = self.rho[j]*tf.tensordot(self.Y[j], r, 1)
+            r += self.S[j]*(alphas.read(i) - b)
+        return -r
+
+    def reset(self, X):
+        # memory is dropped, the loss and gradient are taken at the current weights
+        f,L,g = self.value_and_grad(X)
+        self.k.assign(0)
+        self.f.assign(f)
+        self.g.assign(g)
+        return f,L
+
+    def iteration(self, X):
+        x0 = self.flat(self.var_list)
+        f0,g0 = self.f.read_value(),self.g.read_value()
+
+        d = self.direction(g0)
+        gd = tf.tensordot(g0, d, 1)
+        # a direction that does not descend restarts from the gradient
+        restart = tf.logical_not(gd < 0)
+        d = tf.where(restart, -g0, d)
+        gd = tf.where(restart, -tf.tensordot(g0,g0,1), gd)
+        # without curvature information the first step is scaled by the gradient
+        t = tf.where(tf.logical_or(restart, self.k == 0), tf.minimum(1.0, 1.0/tf.reduce_sum(tf.abs(g0))), 1.0)
+
+        self.assign(x0 + t*d)
+        f,L,g = self.value_and_grad(X)
+        i = 0
+        while tf.logical_not(f <= f0 + self.c1*t*gd) and i < self.max_ls:
+            t = 0.5*t
+            self.assign(x0 + t*d)
+            f,L,g = self.value_and_grad(X)
+            i += 1
+
+        accepted = f <= f0 + self.c1*t*gd
+        if accepted:
+            s = t*d
+            y = g - g0
+            sy = tf.tensordot(s, y, 1)
+            # pairs without positive curvature are skipped
+            if sy > 1e-10*tf.tensordot(y, y, 1):
+                j = self.k % self.m
+                self.S.scatter_nd_update([[j]], s[None])
+                self.Y.scatter_nd_update([[j]], y[None])
+                self.rho.scatter_nd_update([[j]], [1/sy])
+                self.k.assign_add(1)
+            self.f.assign(f)
+            self.g.assign(g)
+        else:
+            # back to the last point, the memory is dropped and the next
+            # iteration searches along the gradient
+            self.assign(x0)
+            self.k.assign(0)
+            f,L,_ = self.value_and_grad(X)
+        return f, L, accepted
+
+    def step(self, X, jit_compile=False):
+        if jit_compile not in self.steps:
+            self.steps[jit_compile] = tf.function(self.iteration, jit_compile=jit_compile)
+        return self.steps[jit_compile](X)
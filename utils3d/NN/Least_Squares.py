@@ -0,0 +1,198 @@
+import numpy as np
+import tensorflow as tf
+import scipy.linalg
+from scipy.sparse.linalg import lsqr
+from time import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Least_Squares():
+
+    # Output layer fit for PDEs that are linear in u (random feature / ELM
+    # mode). With the hidden layers fixed u = Z c + b is linear in the output
+    # weights, so the loss is a linear least squares problem in them. The
+    # features and their derivatives (Taylor mode) are handed to the PDE as
+    # derivative bundles with one column per unknown, plus a last column
+    # with u = 0 that gives the affine part. Every row then comes from the
+    # same residual, border and interface code as the loss, each row scaled
+    # by the square root of its loss weight (w_r, w_d, w_i, ...) and
+    # quadrature weight, so that |A x - b|^2 is the training loss. A small
+    # ridge term keeps the output weights bounded. Unknowns of several networks
+    # (XPINN) share one system. Nonlinear PDEs are fitted the same way once
+    # their residual is linearized around a frozen u0 (Newton steps).
+
+    def __init__(self, method='qr', rcond=1e-6, block_size=2**14, atol=1e-10, btol=1e-10, iter_lim=None, damping=1e-3, step=1.0, warmup=1000):
+
+        self.DTYPE='float32'
+        # 'qr' (dense, column pivoting) or 'lsqr' (iterative, large systems)
+        self.method = method
+        # relative cut of the QR diagonal, the features are float32
+        self.rcond = rcond
+        self.block_size = block_size
+        self.atol = atol
+        self.btol = btol
+        self.iter_lim = iter_lim
+        # ridge (Tikhonov) weight on the unit column coordinates, it keeps
+        # nearly collinear features from cancelling with huge weights
+        self.damping = damping
+        # fraction of the step from the current output layer (Newton steps)
+        self.step = step
+        # optimizer steps over which the learning rate is ramped up after
+        # the fit, Adam moves every weight by about the learning rate on its
+        # first steps whatever the gradient
+        self.warmup = warmup
+
+    def warm_up(self, optimizer, lr):
+        if self.warmup > 0:
+            optimizer.learning_rate = Warmup(lr, self.warmup)
+
+    def unknowns(self, solvers):
+        for solver in solvers:
+            if not (solver.PDE.linear or solver.PDE.linearized()):
+                raise ValueError(f'{type(solver.PDE).__name__} is not linear in u')
+            if not hasattr(solver.model,'call_features_laplacian'):
+                raise ValueError('The least squares fit needs the features of a PINN_NeuralNet')
+            if solver.model.out.kernel.shape[1] != 1:
+                raise ValueError('The least squares fit needs a single output')
+        # kernel and bias of each output layer, one after the other
+        sizes = [solver.model.out.kernel.shape[0] + 1 for solver in solvers]
+        self.offsets = np.cumsum([0] + sizes)
+        self.n = int(self.offsets[-1])
+
+    def bundle(self, solvers, k, X):
+        # features of network k in its columns of the joint system
+        solver = solvers[k]
+        Z,J,L = solver.model.call_features_laplacian(solver.mesh.stack_X(*X))
+        N = tf.shape(Z)[0]
+        before = int(self.offsets[k])
+        after = self.n - int(self.offsets[k+1]) + 1
+        embed = lambda V,c: tf.concat([tf.zeros([N,before]), V, tf.fill([N,1],c), tf.zeros([N,after])], axis=1)
+        u = embed(Z, 1.0)
+        grad = tuple(embed(J[:,j,:], 0.0) for j in range(3))
+        lap = embed(L, 0.0)
+        return u,grad,lap
+
+
+    # Rows of the loss terms of network k
+
+    def residual_rows(self, solvers, k):
+        solver = solvers[k]
+        PDE = solver.PDE
+        if PDE.X_r_F is None:
+            raise ValueError('The least squares fit needs the residual points in memory')
+        N = len(PDE.X_r_F)
+        rows = list()
+        for i in range(0, N, self.block_size):
+            X_batch,F = PDE.split_features(PDE.X_r_F[i:i+self.block_size])
+            X = solver.mesh.get_X(X_batch)
+            PDE.clear_bundles()
+            PDE.set_bundle(solver.model, X, self.bundle(solvers,k,X))
+            r = PDE.residual(solver.mesh,solver.model,X,F)
+            rows.append(tf.sqrt(solver.w['r']*F.get('weight',1.0)/N)*r)
+        return rows
+
+    def border_rows(self, solvers, k):
+        solver = solvers[k]
+        PDE = solver.PDE
+        if PDE.XB_data is None:
+            return list()
+        PDE.clear_bundles()
+        PDE.set_bundle(solver.model, PDE.XB, self.bundle(solvers,k,PDE.XB))
+        r = PDE.border_residual(solver.mesh,solver.model)
+        w = tf.constant([[solver.w[t]] for t in PDE.border_types], dtype=self.DTYPE)
+        scale = tf.gather(w/PDE.segment_sizes, PDE.segment_ids)*PDE.WB_data
+        return [tf.sqrt(scale)*r]
+
+    def interface_rows(self, interface, solvers, k):
+        solver,solver_ex = solvers[k],solvers[1-k]
+        rows = list()
+        for j in range(len(solver.PDE.XI_data)):
+            X = solver.mesh.get_X(solver.PDE.XI_data[j])
+            interface.clear_bundles()
+            interface.set_bundle(solver.model, X, self.bundle(solvers,k,X))
+            interface.set_bundle(solver_ex.model, X, self.bundle(solvers,1-k,X))
+            r_u,r_n = interface.jump(solver,solver_ex,X,j)
+            scale = tf.sqrt(solver.w_i*solver.PDE.WI_data[j]/len(X[0]))
+            rows += [scale*r_u, scale*r_n]
+        return rows
+
+    def system(self, solvers, interface=None):
+        rows = list()
+        for k in range(len(solvers)):
+            rows += self.residual_rows(solvers,k) + self.border_rows(solvers,k)
+            if interface != None:
+                rows += self.interface_rows(interface,solvers,k)
+        for solver in solvers:
+            solver.PDE.clear_bundles()
+        if interface != None:
+            interface.clear_bundles()
+        R = np.concatenate([r.numpy().astype(np.float64) for r in rows])
+        return R[:,:-1] - R[:,-1:], -R[:,-1]
+
+
+    def solve(self, solvers, interface=None):
+        t0 = time()
+        self.unknowns(solvers)
+        A,b = self.system(solvers, interface)
+
+        # unit columns, the scale of the features varies a lot
+        norms = np.linalg.norm(A, axis=0)
+        norms[norms == 0] = 1
+        A /= norms
+
+        if self.method == 'qr':
+            x = self.solve_qr(A,b)
+        elif self.method == 'lsqr':
+            x = self.solve_lsqr(A,b)
+        else:
+            raise ValueError(f'Unknown least squares method: {self.method}')
+        loss = float(np.sum(np.square(A@x - b)))
+        x /= norms
+
+        for k,solver in enumerate(solvers):
+            beta = x[self.offsets[k]:self.offsets[k+1]]
+            kernel,bias = solver.model.out.kernel,solver.model.out.bias
+            kernel.assign(kernel + self.step*(beta[:-1,None].astype(self.DTYPE) - kernel))
+            bias.assign(bias + self.step*(beta[-1:].astype(self.DTYPE) - bias))
+
+        logger.info(f'Least squares ({self.method}): {A.shape[0]} rows, {self.n} unknowns, '
+                    f'loss {loss:.4e}, {time()-t0:.2f} s')
+        return loss
+
+    def solve_qr(self, A, b):
+        # ridge as the stacked system [A; damping I] x = [b; 0], the columns
+        # past the numerical rank are left at zero
+        n = A.shape[1]
+        if self.damping > 0:
+            A = np.concatenate([A, self.damping*np.eye(n)])
+            b = np.concatenate([b, np.zeros(n)])
+        Q,R,P = scipy.linalg.qr(A, mode='economic', pivoting=True)
+        d = np.abs(np.diag(R))
+        rank = int(np.sum(d > self.rcond*d[0]))
+        x = np.zeros(A.shape[1])
+        x[P[:rank]] = scipy.linalg.solve_triangular(R[:rank,:rank], Q[:,:rank].T@b)
+        logger.info(f'QR: rank {rank} of {A.shape[1]}')
+        return x
+
+    def solve_lsqr(self, A, b):
+        result = lsqr(A, b, damp=self.damping, atol=self.atol, btol=self.btol, iter_lim=self.iter_lim)
+        logger.info(f'LSQR: {result[2]} iterations, stop reason {result[1]}')
+        return result[0]
+
+
+class Warmup(tf.keras.optimizers.schedules.LearningRateSchedule):
+
+    # linear ramp of a schedule over its first steps
+
+    def __init__(self, schedule, steps):
+        self.schedule = schedule
+        self.steps = steps
+
+    def __call__(self, step):
+        ramp = tf.minimum(1.0, tf.cast(step + 1, 'float32')/self.steps)
+        return self.schedule(step)*ramp
+
+    def get_config(self):
+        return {'schedule': tf.keras.optimizers.schedules.serialize(self.schedule), 'steps': self.steps}
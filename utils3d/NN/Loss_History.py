@@ -0,0 +1,46 @@
+import numpy as np
+
+
+class Loss_History():
+
+    def __init__(self, names, every=1, capacity=1024):
+
+        self.DTYPE='float32'
+        self.names = ['iter'] + list(names)
+        self.columns = {name: j for j,name in enumerate(self.names)}
+        self.every = every
+        self.data = np.zeros((capacity, len(self.names)), dtype=self.DTYPE)
+        self.n = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.n
+
+    # Column view of the stored rows, no copy
+    def __getitem__(self, name):
+        return self.data[:self.n, self.columns[name]]
+
+    def append(self, values):
+        # values: sequence ordered as names (without 'iter')
+        self.count += 1
+        if (self.count - 1) % self.every != 0:
+            return
+        if self.n == len(self.data):
+            grown = np.zeros((2*len(self.data), len(self.names)), dtype=self.DTYPE)
+            grown[:self.n] = self.data[:self.n]
+            self.data = grown
+        self.data[self.n,0] = self.count - 1
+        self.data[self.n,1:] = np.array(values, dtype=self.DTYPE)
+        self.n += 1
+
+    def to_numpy(self, every=1):
+        return {name: np.array(self.data[:self.n:every, j]) for name,j in self.columns.items()}
+
+    def state(self):
+        return self.data[:self.n], self.count
+
+    def load_state(self, data, count):
+        self.data = np.zeros((max(2*len(data),1024), len(self.names)), dtype=self.DTYPE)
+        self.data[:len(data)] = data
+        self.n = len(data)
+        self.count = int(count)
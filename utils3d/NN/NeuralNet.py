@@ -11,6 +11,7 @@ class PINN_NeuralNet(tf.keras.Model):
             num_hidden_blocks='8',
             activation='tanh',
             kernel_initializer='glorot_normal',
+            bias_initializer='zeros',
             architecture_Net='FCNN',
             **kwargs):
         super().__init__(**kwargs)
@@ -37,6 +38,7 @@ class PINN_NeuralNet(tf.keras.Model):
                 layer = tf.keras.layers.Dense(num_neurons_per_layer,
                                         activation=tf.keras.activations.get(activation),
                                         kernel_initializer=kernel_initializer,
+                                        bias_initializer=bias_initializer,
                                         name=f'layer_{i}')
                 self.hidden_layers.append(layer)
 
@@ -45,20 +47,24 @@ class PINN_NeuralNet(tf.keras.Model):
             self.first = tf.keras.layers.Dense(num_neurons_per_layer,
                                             activation=tf.keras.activations.get(activation),
                                             kernel_initializer=kernel_initializer,
+                                            bias_initializer=bias_initializer,
                                             name=f'layer_0')
             self.hidden_blocks = list()
             for i in range(self.num_hidden_blocks):
                 block = tf.keras.Sequential(name=f"block_{i}")
                 block.add(tf.keras.layers.Dense(num_neurons_per_layer,
                                                 activation=tf.keras.activations.get(activation),
-                                                kernel_initializer=kernel_initializer))
+                                                kernel_initializer=kernel_initializer,
+                                                bias_initializer=bias_initializer))
                 block.add(tf.keras.layers.Dense(num_neurons_per_layer,
                                                 activation=tf.keras.activations.get(activation),
-                                                kernel_initializer=kernel_initializer))
+                                                kernel_initializer=kernel_initializer,
+                                                bias_initializer=bias_initializer))
                 self.hidden_blocks.append(block)
             self.last = tf.keras.layers.Dense(num_neurons_per_layer,
                                             activation=tf.keras.activations.get(activation),
                                             kernel_initializer=kernel_initializer,
+                                            bias_initializer=bias_initializer,
                                             name=f'layer_1')
             
             
@@ -79,15 +85,107 @@ class PINN_NeuralNet(tf.keras.Model):
     # Call NeuralNet functions with the desire architecture
     
     def call_FCNN(self,X):
+        return self.out(self.features_FCNN(X))
+
+    def call_ResNet(self,X):
+        return self.out(self.features_ResNet(X))
+
+
+    # Features: the last hidden layer, the output is linear in them
+
+    def call_features(self,X):
+        if self.architecture_Net == 'FCNN':
+            return self.features_FCNN(X)
+        elif self.architecture_Net == 'ResNet':
+            return self.features_ResNet(X)
+
+    def features_FCNN(self,X):
         Z = self.scale(X)
         for layer in self.hidden_layers:
             Z = layer(Z)
-        return self.out(Z)
+        return Z
 
-    def call_ResNet(self,X):
+    def features_ResNet(self,X):
         Z = self.scale(X)
         Z = self.first(Z)
         for block in self.hidden_blocks:
             Z = block(Z) + Z
         Z = self.last(Z)
-        return self.out(Z)
+        return Z
+
+
+    # Value, gradient and laplacian in one forward pass (Taylor mode). For
+    # every unit Z the pass carries its jacobian J (N,3,m) and laplacian L
+    # (N,m) with respect to the input coordinates.
+
+    def call_laplacian(self,X):
+        return self.taylor_output(*self.call_features_laplacian(X))
+
+    def call_features_laplacian(self,X):
+        if self.architecture_Net == 'FCNN':
+            return self.features_laplacian_FCNN(X)
+        elif self.architecture_Net == 'ResNet':
+            return self.features_laplacian_ResNet(X)
+
+    def features_laplacian_FCNN(self,X):
+        Z,J,L = self.taylor_scale(X)
+        for layer in self.hidden_layers:
+            Z,J,L = self.taylor_dense(layer,Z,J,L)
+        return Z,J,L
+
+    def features_laplacian_ResNet(self,X):
+        Z,J,L = self.taylor_scale(X)
+        Z,J,L = self.taylor_dense(self.first,Z,J,L)
+        for block in self.hidden_blocks:
+            Zb,Jb,Lb = Z,J,L
+            for layer in block.layers:
+                Zb,Jb,Lb = self.taylor_dense(layer,Zb,Jb,Lb)
+            Z,J,L = Zb+Z, Jb+J, Lb+L
+        Z,J,L = self.taylor_dense(self.last,Z,J,L)
+        return Z,J,L
+
+    def taylor_scale(self,X):
+        a = 2.0/(self.ub - self.lb)
+        Z = self.scale(X)
+        J = tf.broadcast_to(tf.linalg.diag(a), [tf.shape(X)[0],3,3])
+        L = tf.zeros_like(Z)
+        return Z,J,L
+
+    def taylor_dense(self,layer,Z,J,L):
+        W = layer.kernel
+        Z = tf.matmul(Z,W) + layer.bias
+        J = tf.einsum('nim,mk->nik',J,W)
+        L = tf.matmul(L,W)
+        s,ds,d2s = self.activation_derivatives(layer.activation,Z)
+        L = ds*L + d2s*tf.reduce_sum(tf.square(J),axis=1)
+        J = tf.expand_dims(ds,axis=1)*J
+        return s,J,L
+
+    def taylor_output(self,Z,J,L):
+        W = self.out.kernel
+        u = tf.matmul(Z,W) + self.out.bias
+        grad = tf.einsum('nim,mk->nik',J,W)[:,:,0]
+        lap = tf.matmul(L,W)
+        return u,grad,lap
+
+    def activation_derivatives(self,activation,Z):
+        name = getattr(activation,'__name__',None)
+        if name == 'tanh':
+            s = tf.tanh(Z)
+            ds = 1 - s**2
+            return s, ds, -2*s*ds
+        if name == 'sigmoid':
+            s = tf.sigmoid(Z)
+            ds = s*(1-s)
+            return s, ds, ds*(1-2*s)
+        if name == 'linear':
+            return Z, tf.ones_like(Z), tf.zeros_like(Z)
+        # other activations are elementwise, their derivatives come from a tape
+        with tf.GradientTape() as tape2:
+            tape2.watch(Z)
+            with tf.GradientTape() as tape1:
+                tape1.watch(Z)
+                s = activation(Z)
+            ds = tape1.gradient(s,Z)
+        d2s = tape2.gradient(ds,Z)
+        return s, ds, d2s
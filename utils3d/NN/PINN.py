@@ -6,23 +6,55 @@ from time import time
 from tqdm import tqdm as log_progress
 import logging
 
+from NN.Loss_History import Loss_History
+from NN.Checkpoint import Checkpoint_Manager, build_optimizer
+from NN.LBFGS import LBFGS
+from NN.Least_Squares import Least_Squares
+from NN.Epoch_Batches import Epoch_Batches
+
 logger = logging.getLogger(__name__)
 
 class PINN():
     
-    def __init__(self):
+    def __init__(self, loss_every=1):
 
         self.DTYPE='float32'
        
-        self.loss_hist = list()
-        self.loss_r = list()
-        self.loss_bD = list()
-        self.loss_bN = list()
-        self.loss_bK = list()
+        self.history = Loss_History(['loss','r','D','N','K','I'], every=loss_every)
         self.loss_P = list()
-        self.loss_bI = list()
         self.iter = 0
         self.lr = None
+        self.optimizer = None
+        self.resumed = False
+        self.seed = 1234
+        self.adaptive_sampler = None
+        self.curriculum = None
+        self.level = None
+        self.batches = dict()
+
+    @property
+    def loss_hist(self):
+        return self.history['loss']
+
+    @property
+    def loss_r(self):
+        return self.history['r']
+
+    @property
+    def loss_bD(self):
+        return self.history['D']
+
+    @property
+    def loss_bN(self):
+        return self.history['N']
+
+    @property
+    def loss_bK(self):
+        return self.history['K']
+
+    @property
+    def loss_bI(self):
+        return self.history['I']
  
 
     def adapt_mesh(self, mesh,
@@ -72,6 +104,19 @@ class PINN():
         self.lr = tf.keras.optimizers.schedules.PiecewiseConstantDecay(*lr)
         logger.info("Neural Network adapted")
 
+    def resume(self,run_dir):
+        logger.info("> Resuming PINN")
+        self.optimizer = tf.keras.optimizers.Adam(learning_rate=self.lr)
+        build_optimizer(self.optimizer, self.model.trainable_variables)
+        directory = os.path.join(os.getcwd(),run_dir,'checkpoints')
+        checkpoint = Checkpoint_Manager(directory, [self.model], [self.optimizer], [self.history], states=self.checkpoint_states())
+        self.iter, self.precondition = checkpoint.restore()
+        self.update_level(self.iter)
+        checkpoint.load_states()
+        self.current_loss = self.loss_hist[-1]
+        self.resumed = True
+        logger.info(f'Resumed at iteration {self.iter}')
+
     def save_model(self,directory,name):
         dir_path = os.path.join(os.getcwd(),directory)
         if not os.path.exists(dir_path):
@@ -98,87 +143,326 @@ class PINN():
         del tape
         return loss, L, g
     
-    def solve_TF_optimizer(self, optimizer, N=1001, N_precond=10, N_batches=1):
-        @tf.function
+    def solve_TF_optimizer(self, optimizer, N=1001, N_precond=10, N_batches=1, N_sync=1, jit_compile=False):
         def train_step(X_batch, precond=False):
             loss, L_loss, grad_theta = self.get_grad(X_batch, precond)
             optimizer.apply_gradients(zip(grad_theta, self.model.trainable_variables))
             return loss, L_loss
-        
-        batches_X_r, batches_X_r_P = self.create_batches(N_batches)
 
+        self.traces = {'r': 0, 'P': 0}
+        train_steps = dict()
+
+        # compiled steps are fixed to a batch shape, a pruned active set
+        # gets a new one for each bucket size
+        def get_step(spec, precond):
+            key = (precond, spec) if jit_compile else precond
+            if key not in train_steps:
+                train_steps[key] = self.compile_step(train_step, spec, precond, jit_compile)
+            return train_steps[key]
+
+        # K epochs of N batches on device, losses of the last batch of each
+        # epoch are written to a buffer and transferred to the host once
+        @tf.function
+        def train_epochs(iterator, N, K, precond=False):
+            buffer = tf.TensorArray(self.DTYPE, size=K)
+            steps = tf.constant(0)
+            for k in tf.range(K):
+                values = tf.zeros(len(self.L_names)+1, dtype=self.DTYPE)
+                for j in tf.range(N):
+                    loss,L_loss = get_step(iterator.element_spec, precond)(iterator.get_next())
+                    values = tf.stack([loss] + [tf.cast(L_loss[t],self.DTYPE) for t in self.L_names])
+                    steps += 1
+                buffer = buffer.write(k, values)
+            return buffer.stack(), steps
+        
         N_j = 0
-        pbar = log_progress(range(N))
+        pbar = log_progress(total=N)
         pbar.set_description("Loss: %s " % 100)
-        for i in pbar:
-
-            if not self.precondition:
-                shuffled_batches_X_r = batches_X_r.shuffle(buffer_size=len(self.PDE.X_r))
-                for X_batch in shuffled_batches_X_r:
-                    N_j += 1
-                    loss,L_loss = train_step(X_batch, self.precondition)
-            
-            if self.precondition:
-                shuffled_batches_X_r_P = batches_X_r_P.shuffle(buffer_size=len(self.PDE.X_r_P))
-                for X_batch in shuffled_batches_X_r_P:
+        i = 0
+        while i < N:
+
+            self.update_level(self.iter)
+            if self.adaptive_sampler != None and not self.precondition and self.adaptive_sampler.due(self.iter):
+                self.adaptive_sampler.resample(self.model, self.seed+self.iter)
+            if self.PDE.active_set != None and not self.precondition and self.PDE.active_set.due(self.iter):
+                self.PDE.active_set.prune(self.seed+self.iter)
+
+            # shuffles are seeded with the iteration so resumed runs see the
+            # same batches as uninterrupted ones
+            batches = self.epoch_batches(N_batches, self.precondition, drop_remainder=jit_compile)
+            step = get_step(batches.iterator.element_spec, self.precondition)
+
+            if N_sync > 1:
+                K = self.sync_epochs(N - i, N_sync, N_precond)
+                values,steps = train_epochs(batches.iterator, tf.constant(batches.N), tf.constant(K), self.precondition)
+                N_j += int(steps)
+                for row in values.numpy():
+                    self.callback(row[0], dict(zip(self.L_names,row[1:])))
+            else:
+                K = 1
+                for j in range(batches.N):
                     N_j += 1
-                    loss,L_loss = train_step(X_batch, self.precondition)
+                    loss,L_loss = step(batches.iterator.get_next())
 
-            self.callback(loss,L_loss)
+                self.callback(loss,L_loss)
+            batches.advance(K)
+            i += K
+            pbar.update(K)
 
             if self.iter>N_precond:
                 self.precondition = False
 
-            if self.iter % 10 == 0:
+            if self.iter % 10 == 0 or N_sync > 1:
                 pbar.set_description("Loss: {:6.4e}".format(self.current_loss))
 
-            if self.save_model_iter > 0:
-                if self.iter % self.save_model_iter == 0:
-                    self.save_model(self.folder_path, f'model_{self.iter}')
+            self.save_iteration()
+        pbar.close()
+        if self.save_checkpoint_iter > 0:
+            self.checkpoint.wait()
             
         logger.info(f' Iterations: {N}')
         logger.info(f' Total steps: {N_j}')
+        logger.info(f' Traces: {self.traces}')
         logger.info(" Loss: {:6.4e}".format(self.current_loss))
 
+    def solve_LBFGS(self, N, options=None, jit_compile=False):
+        # full batch second phase, iterations continue the count, history
+        # and checkpoints of the first optimizer. Resampling and pruning are
+        # paused so the objective stays fixed
+        self.update_level(self.iter)
+        self.precondition = False
+        X = self.full_batch()
+        optimizer = LBFGS(self.loss_fn, self.model.trainable_variables, **(options or dict()))
+        optimizer.reset(X)
+
+        pbar = log_progress(total=N)
+        pbar.set_description("Loss: %s " % 100)
+        failed = False
+        for i in range(N):
+            loss,L_loss,accepted = optimizer.step(X, jit_compile)
+            self.callback(loss,L_loss)
+            pbar.update(1)
+            if self.iter % 10 == 0:
+                pbar.set_description("Loss: {:6.4e}".format(self.current_loss))
+            self.save_iteration()
+            # a second failure in a row was already along the gradient
+            if not accepted and failed:
+                logger.info(f'L-BFGS: no decrease along the gradient at iteration {self.iter}')
+                break
+            failed = not bool(accepted)
+        pbar.close()
+        if self.save_checkpoint_iter > 0:
+            self.checkpoint.wait()
+
+        logger.info(f' L-BFGS iterations: {i+1}')
+        logger.info(" Loss: {:6.4e}".format(self.current_loss))
 
-    def create_batches(self, N_batches):
-
-        number_batches = N_batches
-
-        dataset_X_r = tf.data.Dataset.from_tensor_slices(self.PDE.X_r)
-        dataset_X_r = dataset_X_r.shuffle(buffer_size=len(self.PDE.X_r))
-
-        batch_size = int(len(self.PDE.X_r)/number_batches)
-        batches_X_r = dataset_X_r.batch(batch_size)
-
-
-        dataset_X_r_P = tf.data.Dataset.from_tensor_slices(self.PDE.X_r_P)
-        dataset_X_r_P = dataset_X_r_P.shuffle(buffer_size=len(self.PDE.X_r_P))
-
-        batch_size = int(len(self.PDE.X_r_P)/number_batches)
-        batches_X_r_P = dataset_X_r_P.batch(batch_size)
+    def solve_least_squares(self, options=None):
+        # output layer fit on the current hidden layers, recorded as one
+        # iteration. It takes the place of the preconditioning
+        Least_Squares(**(options or dict())).solve([self])
+        self.precondition = False
+        loss,L_loss = self.loss_fn(self.full_batch())
+        self.callback(loss,L_loss)
+        self.save_iteration()
+        logger.info(" Loss: {:6.4e}".format(self.current_loss))
 
-        return batches_X_r, batches_X_r_P
+    def solve_newton(self, optimizer, iterations=10, inner='least_squares', least_squares=None, tol=0, N_batches=1, N_sync=1, jit_compile=False):
+        # Newton iterations for a nonlinear residual: the output is frozen as
+        # u0, the residual is linearized around it and the linear problem is
+        # solved by the output layer least squares fit (one iteration) or by
+        # `inner` warm started epochs of the optimizer. Resampling and the
+        # curriculum are paused so the linearized problem stays fixed, a new
+        # level would drop the u0 column
+        self.precondition = False
+        self.update_level(self.iter)
+        sampler,self.adaptive_sampler = self.adaptive_sampler,None
+        curriculum,self.curriculum = self.curriculum,None
+        for k in range(iterations):
+            self.PDE.linearize(self.model)
+            if inner == 'least_squares':
+                Least_Squares(**(least_squares or dict())).solve([self])
+            else:
+                self.solve_TF_optimizer(optimizer, inner, 0, N_batches=N_batches, N_sync=N_sync, jit_compile=jit_compile)
+            self.PDE.linearize(None)
+
+            loss,L_loss = self.loss_fn(self.full_batch())
+            if inner == 'least_squares':
+                self.callback(loss,L_loss)
+                self.save_iteration()
+            logger.info(f'Newton iteration {k+1}: loss {float(loss):6.4e}')
+            if loss <= tol:
+                break
+        self.adaptive_sampler = sampler
+        self.curriculum = curriculum
+        if self.save_checkpoint_iter > 0:
+            self.checkpoint.wait()
+
+    def checkpoint_states(self):
+        # resampled points first, the active set is rebuilt on them
+        return [hook for hook in [self.adaptive_sampler, self.PDE.active_set] if hook != None]
+
+    def save_iteration(self):
+        if self.save_model_iter > 0:
+            if self.iter % self.save_model_iter == 0:
+                self.save_model(self.folder_path, f'model_{self.iter}')
+
+        if self.save_checkpoint_iter > 0:
+            if self.iter % self.save_checkpoint_iter == 0:
+                self.checkpoint.save(self.iter, self.precondition)
+
+    def compile_step(self, train_step, signature, precond, jit_compile=False):
+        # one function per phase. With jit_compile the batch shapes are fixed
+        # by the input signature, so each phase is traced and compiled once.
+        # Otherwise the batch dimension is left open and point sets of any
+        # size (curriculum levels, last batches) share one trace
+        name = 'P' if precond else 'r'
+        def step(X_batch):
+            self.traces[name] += 1
+            return train_step(X_batch, precond)
+        if jit_compile:
+            return tf.function(step, input_signature=[signature], jit_compile=True)
+        relaxed = tf.nest.map_structure(lambda spec: tf.TensorSpec([None]+spec.shape[1:], spec.dtype), signature)
+        return tf.function(step, input_signature=[relaxed])
+
+    def sync_epochs(self, N_left, N_sync, N_precond):
+        # epochs until the next host sync, ending chunks at the end of the
+        # preconditioning phase, at model saves and at resampling
+        K = min(N_sync, N_left)
+        if self.precondition:
+            K = min(K, N_precond + 1 - self.iter)
+        if self.save_model_iter > 0:
+            K = min(K, self.save_model_iter - self.iter % self.save_model_iter)
+        if self.save_checkpoint_iter > 0:
+            K = min(K, self.save_checkpoint_iter - self.iter % self.save_checkpoint_iter)
+        for hook in [self.adaptive_sampler, self.PDE.active_set]:
+            if hook != None:
+                K = min(K, hook.every - self.iter % hook.every)
+        K = min(K, self.level_epochs(self.iter))
+        return max(K,1)
+
+
+    def epoch_batches(self, N_batches, precond=False, drop_remainder=False):
+        # built again when the point set changes (levels, resampling,
+        # pruning) or when the epochs are out of step with the iterations
+        X = self.PDE.X_r_P_F if precond else self.residual_points()
+        shards = self.mesh.streamed(precond)
+        batches = self.batches.get(precond)
+        if batches is None or not batches.valid([X,shards], (N_batches,drop_remainder), self.iter):
+            epoch,N = self.residual_batches(X, shards, N_batches, drop_remainder, precond)
+            batches = Epoch_Batches(lambda e: epoch(self.seed + e), N, self.iter, [X,shards], (N_batches,drop_remainder))
+            self.batches[precond] = batches
+        return batches
+
+    # Coarse to fine curriculum. Each level, e.g. {'N_r': 15, 'epochs': 100},
+    # trains on its own residual set for the given iterations, then the mesh
+    # set takes over. The optimizer and the compiled steps are kept
+    def set_curriculum(self, levels):
+        if self.mesh.streamed() != None:
+            raise ValueError('A curriculum needs the residual points in memory')
+        sampler = self.mesh.mesh_N.get('sampler','grid')
+        rmin,rmax = self.mesh.ins_domain['rmin'],self.mesh.ins_domain['rmax']
+        self.curriculum = list()
+        until = 0
+        for level in levels:
+            until += level['epochs']
+            X = self.mesh.domain_sampler.points(sampler, level['N_r'], rmin, rmax)
+            self.curriculum.append((until,) + self.mesh.split_weights(X))
+        self.curriculum.append((None, self.PDE.X_r, self.mesh.W_r))
+
+    def update_level(self, iter):
+        if self.curriculum is None:
+            return
+        level = next(l for l in self.curriculum if l[0] is None or iter < l[0])
+        if level is not self.level:
+            self.level = level
+            self.PDE.set_residual_points(*level[1:])
+            if self.PDE.active_set != None:
+                self.PDE.active_set.reset()
+            logger.info(f'Curriculum: {len(level[1])} residual points from iteration {iter}')
+
+    def level_epochs(self, iter):
+        # iterations left in the current level
+        if self.curriculum is None:
+            return np.inf
+        return min([l[0] - iter for l in self.curriculum if l[0] != None and l[0] > iter], default=np.inf)
+
+    def full_batch(self):
+        # every residual point in one batch, pruned ones included
+        if self.mesh.streamed() != None:
+            raise ValueError('L-BFGS needs the residual points in memory')
+        if self.PDE.active_set != None:
+            return self.PDE.active_set.X_F
+        return self.PDE.X_r_F
+
+    def residual_points(self):
+        # the residual set, or its unconverged part when pruning is enabled
+        if self.PDE.active_set != None:
+            return self.PDE.active_set.points()
+        return self.PDE.X_r_F
+
+    def residual_batches(self, X, shards, N_batches, drop_remainder=False, precond=False):
+        # the batches of one epoch as a function of its seed, and their
+        # number. Dropping the remainder keeps every batch at the same static
+        # shape. X holds the coordinates followed by the precomputed feature
+        # columns
+        if shards != None:
+            batch_size = int(shards.size/N_batches)
+            # streamed points (shards or fresh draws) get their features in
+            # the input pipeline
+            if shards.columns > 3:
+                features = lambda X_batch: self.PDE.with_features(X_batch[:,:3], precond, X_batch[:,3:])
+            else:
+                features = lambda X_batch: self.PDE.with_features(X_batch, precond)
+            def epoch(seed):
+                batches = shards.dataset(batch_size, drop_remainder=drop_remainder, seed=seed)
+                return batches.map(features, num_parallel_calls=tf.data.AUTOTUNE)
+            return epoch, shards.batches(batch_size, drop_remainder)
+
+        # X is embedded once, each epoch gathers the batches of a stateless
+        # permutation of its rows
+        N = len(X)
+        batch_size = int(N/N_batches)
+        def epoch(seed):
+            index = tf.random.experimental.stateless_shuffle(tf.range(N), seed=tf.stack([seed, 0]))
+            batches = tf.data.Dataset.from_tensor_slices(index).batch(batch_size, drop_remainder=drop_remainder)
+            return batches.map(lambda index: tf.gather(X, index))
+        return epoch, N//batch_size if drop_remainder else -(-N//batch_size)
  
 
     def callback(self,loss,L_loss):
-        self.loss_r.append(L_loss['r'])
-        self.loss_bD.append(L_loss['D'])
-        self.loss_bK.append(L_loss['K'])
-        self.loss_bN.append(L_loss['N'])
-        self.current_loss = loss.numpy()
-        self.loss_hist.append(self.current_loss)
+        self.current_loss = np.float32(loss)
+        self.history.append([loss, L_loss['r'], L_loss['D'], L_loss['N'], L_loss['K'], L_loss.get('I',0)])
         self.iter+=1
 
-    def solve(self,N=1000, precond=False, N_precond=10, N_batches=1, save_model=0):
+    def solve(self,N=1000, precond=False, N_precond=10, N_batches=1, save_model=0, N_sync=1, save_checkpoint=0, N_checkpoints=3, jit_compile=False, N_lbfgs=0, lbfgs=None, least_squares=None, newton=None):
         
-        self.precondition = precond
+        if not self.resumed:
+            self.precondition = precond
         self.save_model_iter = save_model
-        optim = tf.keras.optimizers.Adam(learning_rate=self.lr)
+        self.save_checkpoint_iter = save_checkpoint
+        if self.optimizer is None:
+            # slots are created before the first step so it is traced only once
+            self.optimizer = tf.keras.optimizers.Adam(learning_rate=self.lr)
+            build_optimizer(self.optimizer, self.model.trainable_variables)
+        optim = self.optimizer
+        if least_squares != None or newton != None:
+            Least_Squares(**(least_squares or newton.get('least_squares') or dict())).warm_up(optim, self.lr)
         self.N_iters = N
 
+        if save_checkpoint > 0:
+            directory = os.path.join(os.getcwd(),self.folder_path,'checkpoints')
+            self.checkpoint = Checkpoint_Manager(directory, [self.model], [optim], [self.history], max_to_keep=N_checkpoints, states=self.checkpoint_states())
+
         t0 = time()
-        self.solve_TF_optimizer(optim, N, N_precond, N_batches=N_batches)
+        if least_squares != None and not self.resumed:
+            self.solve_least_squares(least_squares)
+        if newton != None and not self.resumed:
+            self.solve_newton(optim, **newton, N_batches=N_batches, N_sync=N_sync, jit_compile=jit_compile)
+        if self.iter < N:
+            self.solve_TF_optimizer(optim, N - self.iter, N_precond, N_batches=N_batches, N_sync=N_sync, jit_compile=jit_compile)
+        if self.iter < N + N_lbfgs:
+            self.solve_LBFGS(N + N_lbfgs - self.iter, lbfgs, jit_compile=jit_compile)
         logger.info('Computation time: {} minutes'.format(int((time()-t0)/60)))
 
 
@@ -5,34 +5,79 @@ from tqdm import tqdm as log_progress
 import logging
 import os
 
+from NN.Loss_History import Loss_History
+from NN.Checkpoint import Checkpoint_Manager, build_optimizer
+from NN.LBFGS import LBFGS
+from NN.Least_Squares import Least_Squares
+from NN.Epoch_Batches import Epoch_Batches
+
 logger = logging.getLogger(__name__)
 
 
 class XPINN():
     
-    def __init__(self, PINN):
+    def __init__(self, PINN, loss_every=1):
 
         self.DTYPE = 'float32'
 
-        self.solver1, self.solver2 = PINN(), PINN()
+        self.solver1, self.solver2 = PINN(loss_every), PINN(loss_every)
         self.solvers = [self.solver1,self.solver2]
         
-        self.loss_hist = list()
-
-        self.loss_r1 = list()
-        self.loss_bD1 = list()
-        self.loss_bN1 = list()
-        self.loss_bI1 = list()
-        self.loss_bK1 = list()
-
-        self.loss_r2 = list()
-        self.loss_bD2 = list()
-        self.loss_bN2 = list()
-        self.loss_bI2 = list()
-        self.loss_bK2 = list()
+        # per solver terms are kept in each solver history
+        self.history = Loss_History(['loss'], every=loss_every)
 
         self.iter = 0
         self.lr = None
+        self.optimizers = None
+        self.resumed = False
+        self.seed = 1234
+        self.L_names = ['r','D','N','K','I']
+        self.batches = dict()
+
+
+    @property
+    def loss_hist(self):
+        return self.history['loss']
+
+    @property
+    def loss_r1(self):
+        return self.solver1.loss_r
+
+    @property
+    def loss_bD1(self):
+        return self.solver1.loss_bD
+
+    @property
+    def loss_bN1(self):
+        return self.solver1.loss_bN
+
+    @property
+    def loss_bI1(self):
+        return self.solver1.loss_bI
+
+    @property
+    def loss_bK1(self):
+        return self.solver1.loss_bK
+
+    @property
+    def loss_r2(self):
+        return self.solver2.loss_r
+
+    @property
+    def loss_bD2(self):
+        return self.solver2.loss_bD
+
+    @property
+    def loss_bN2(self):
+        return self.solver2.loss_bN
+
+    @property
+    def loss_bI2(self):
+        return self.solver2.loss_bI
+
+    @property
+    def loss_bK2(self):
+        return self.solver2.loss_bK
 
 
     def adapt_PDEs(self,PDE):
@@ -44,6 +89,7 @@ class XPINN():
     def adapt_meshes(self,meshes,weights):
         for solver,mesh,weight in zip(self.solvers,meshes,weights):
             solver.adapt_mesh(mesh,**weight)
+        self.PDE.adapt_interface(self.solvers)
 
     def create_NeuralNets(self,NN_class,lrs,hyperparameters):
         for solver,lr,hyperparameter in zip(self.solvers,lrs,hyperparameters):
@@ -53,6 +99,26 @@ class XPINN():
         for solver,lr,name in zip(self.solvers,lrs,names):
             solver.load_NeuralNet(dirs,name,lr)  
 
+    def resume(self,run_dir):
+        logger.info("> Resuming XPINN")
+        self.optimizers = list()
+        for solver in self.solvers:
+            optimizer = tf.keras.optimizers.Adam(learning_rate=solver.lr)
+            build_optimizer(optimizer, solver.model.trainable_variables)
+            self.optimizers.append(optimizer)
+        directory = os.path.join(os.getcwd(),run_dir,'checkpoints')
+        models = [solver.model for solver in self.solvers]
+        histories = [self.history] + [solver.history for solver in self.solvers]
+        states = [state for solver in self.solvers for state in solver.checkpoint_states()]
+        checkpoint = Checkpoint_Manager(directory, models, self.optimizers, histories, states=states)
+        self.iter, self.precondition = checkpoint.restore()
+        for solver in self.solvers:
+            solver.update_level(self.iter)
+        checkpoint.load_states()
+        self.current_loss = self.loss_hist[-1]
+        self.resumed = True
+        logger.info(f'Resumed at iteration {self.iter}')
+
     def save_models(self,dirs,names):
         for solver,name in zip(self.solvers,names):
             solver.save_model(dirs,name)   
@@ -78,10 +144,9 @@ class XPINN():
         return loss, L, g
     
     
-    def main_loop(self, optimizer, N=1000, N_precond=10, N_batches=1):
+    def main_loop(self, optimizer, N=1000, N_precond=10, N_batches=1, N_sync=1, jit_compile=False):
         optimizer1,optimizer2 = optimizer
 
-        @tf.function
         def train_step(X_batch, precond=False):
             X_batch1, X_batch2 = X_batch
             loss1, L_loss1, grad_theta1 = self.get_grad(X_batch1, self.solver1,self.solver2, precond)
@@ -93,126 +158,280 @@ class XPINN():
             L1 = [loss1,L_loss1]
             L2 = [loss2,L_loss2]
             return L1,L2
-        
-        batches_r, batches_r_P = self.create_batches(N_batches)
+
+        # each subdomain keeps its own static batch shape
+        self.traces = {'r': 0, 'P': 0}
+        train_steps = dict()
+
+        def get_step(signature, precond):
+            key = (precond, signature) if jit_compile else precond
+            if key not in train_steps:
+                train_steps[key] = self.compile_step(train_step, signature, precond, jit_compile)
+            return train_steps[key]
+
+        # K epochs of N batches on device, losses of the last batch of each
+        # epoch are written to a buffer and transferred to the host once
+        @tf.function
+        def train_epochs(iterator, N, K, precond=False):
+            buffer = tf.TensorArray(self.DTYPE, size=K)
+            steps = tf.constant(0)
+            for k in tf.range(K):
+                values = tf.zeros(2*len(self.L_names)+2, dtype=self.DTYPE)
+                for j in tf.range(N):
+                    L1,L2 = get_step(iterator.element_spec, precond)(iterator.get_next())
+                    values = tf.stack([tf.cast(v,self.DTYPE) for v in self.flat_losses(L1)+self.flat_losses(L2)])
+                    steps += 1
+                buffer = buffer.write(k, values)
+            return buffer.stack(), steps
         
         self.N_iters = N
         N_j = 0
-        pbar = log_progress(range(N))
+        pbar = log_progress(total=N)
         pbar.set_description("Loss: %s " % 100)
-        for i in pbar:
-
-            if not self.precondition:
-                b1,b2 = batches_r
-                shuff_b1 = b1.shuffle(buffer_size=len(self.solver1.PDE.X_r))
-                shuff_b2 = b2.shuffle(buffer_size=len(self.solver2.PDE.X_r))
-                
-                for X_b1, X_b2 in zip(shuff_b1,shuff_b2):
+        i = 0
+        while i < N:
+
+            for solver in self.solvers:
+                solver.update_level(self.iter)
+                if solver.adaptive_sampler != None and not self.precondition and solver.adaptive_sampler.due(self.iter):
+                    solver.adaptive_sampler.resample(solver.model, self.seed+self.iter)
+                if solver.PDE.active_set != None and not self.precondition and solver.PDE.active_set.due(self.iter):
+                    solver.PDE.active_set.prune(self.seed+self.iter)
+
+            # shuffles are seeded with the iteration so resumed runs see the
+            # same batches as uninterrupted ones
+            batches = self.epoch_batches(N_batches, self.precondition, drop_remainder=jit_compile)
+            step = get_step(batches.iterator.element_spec, self.precondition)
+
+            if N_sync > 1:
+                K = self.sync_epochs(N - i, N_sync, N_precond)
+                values,steps = train_epochs(batches.iterator, tf.constant(batches.N), tf.constant(K), self.precondition)
+                N_j += int(steps)
+                n = len(self.L_names)+1
+                for row in values.numpy():
+                    self.callback(self.unflat_losses(row[:n]), self.unflat_losses(row[n:]))
+            else:
+                K = 1
+                for j in range(batches.N):
                     N_j += 1
-                    L1,L2 = train_step((X_b1,X_b2), self.precondition)
-            
-            if self.precondition:
-                b1,b2 = batches_r_P
-                shuff_b1 = b1.shuffle(buffer_size=len(self.solver1.PDE.X_r_P))
-                shuff_b2 = b2.shuffle(buffer_size=len(self.solver2.PDE.X_r_P))
-                
-                for X_b1, X_b2 in zip(shuff_b1,shuff_b2):
-                    N_j += 1
-                    L1,L2 = train_step((X_b1,X_b2), self.precondition)
+                    L1,L2 = step(batches.iterator.get_next())
 
-            self.callback(L1,L2)
+                self.callback(L1,L2)
+            batches.advance(K)
+            i += K
+            pbar.update(K)
 
             if self.iter>N_precond:
                 self.precondition = False
             
-            if self.iter % 5 == 0:
+            if self.iter % 5 == 0 or N_sync > 1:
                 pbar.set_description("Loss: {:6.4e}".format(self.current_loss))
 
-            if self.save_model_iter > 0:
-                if self.iter % self.save_model_iter == 0:
-                    self.save_models(self.folder_path, [f'model_1_{self.iter}',f'model_2_{self.iter}'])
+            self.save_iteration()
+        pbar.close()
+        if self.save_checkpoint_iter > 0:
+            self.checkpoint.wait()
         
         logger.info(f' Iterations: {N}')
         logger.info(f' Total steps: {N_j}')
+        logger.info(f' Traces: {self.traces}')
+        logger.info(" Loss: {:6.4e}".format(self.current_loss))
+
+    def solve_LBFGS(self, N, options=None, jit_compile=False):
+        # both networks in one vector, minimizing the sum of the subdomain
+        # losses so the interface terms move both sides together
+        for solver in self.solvers:
+            solver.update_level(self.iter)
+        self.precondition = False
+        X = tuple(solver.full_batch() for solver in self.solvers)
+
+        def loss_fn(X):
+            X1,X2 = X
+            L1 = self.get_loss(X1, self.solver1,self.solver2, False)
+            L2 = self.get_loss(X2, self.solver2,self.solver1, False)
+            return L1[0] + L2[0], (L1,L2)
+
+        variables = self.solver1.model.trainable_variables + self.solver2.model.trainable_variables
+        optimizer = LBFGS(loss_fn, variables, **(options or dict()))
+        optimizer.reset(X)
+
+        pbar = log_progress(total=N)
+        pbar.set_description("Loss: %s " % 100)
+        failed = False
+        for i in range(N):
+            loss,(L1,L2),accepted = optimizer.step(X, jit_compile)
+            self.callback(L1,L2)
+            pbar.update(1)
+            if self.iter % 5 == 0:
+                pbar.set_description("Loss: {:6.4e}".format(self.current_loss))
+            self.save_iteration()
+            if not accepted and failed:
+                logger.info(f'L-BFGS: no decrease along the gradient at iteration {self.iter}')
+                break
+            failed = not bool(accepted)
+        pbar.close()
+        if self.save_checkpoint_iter > 0:
+            self.checkpoint.wait()
+
+        logger.info(f' L-BFGS iterations: {i+1}')
+        logger.info(" Loss: {:6.4e}".format(self.current_loss))
+
+    def solve_least_squares(self, options=None):
+        # both output layers from one system, coupled by the interface rows
+        Least_Squares(**(options or dict())).solve(self.solvers, self.PDE)
+        self.precondition = False
+        X1,X2 = [solver.full_batch() for solver in self.solvers]
+        L1 = self.get_loss(X1, self.solver1,self.solver2, False)
+        L2 = self.get_loss(X2, self.solver2,self.solver1, False)
+        self.callback(L1,L2)
+        self.save_iteration()
         logger.info(" Loss: {:6.4e}".format(self.current_loss))
+
+    def solve_newton(self, optimizer, iterations=10, inner='least_squares', least_squares=None, tol=0, N_batches=1, N_sync=1, jit_compile=False):
+        # nonlinear subdomains are linearized around their own output, the
+        # linear ones and the interface conditions are kept as they are.
+        # Resampling and the curriculum are paused as for a single PINN
+        self.precondition = False
+        samplers = [solver.adaptive_sampler for solver in self.solvers]
+        curricula = [solver.curriculum for solver in self.solvers]
+        nonlinear = [solver for solver in self.solvers if solver.PDE.newton]
+        for solver in self.solvers:
+            solver.update_level(self.iter)
+            solver.adaptive_sampler = None
+            solver.curriculum = None
+        for k in range(iterations):
+            for solver in nonlinear:
+                solver.PDE.linearize(solver.model)
+            if inner == 'least_squares':
+                Least_Squares(**(least_squares or dict())).solve(self.solvers, self.PDE)
+            else:
+                self.main_loop(optimizer, inner, 0, N_batches=N_batches, N_sync=N_sync, jit_compile=jit_compile)
+            for solver in nonlinear:
+                solver.PDE.linearize(None)
+
+            X1,X2 = [solver.full_batch() for solver in self.solvers]
+            L1 = self.get_loss(X1, self.solver1,self.solver2, False)
+            L2 = self.get_loss(X2, self.solver2,self.solver1, False)
+            loss = L1[0] + L2[0]
+            if inner == 'least_squares':
+                self.callback(L1,L2)
+                self.save_iteration()
+            logger.info(f'Newton iteration {k+1}: loss {float(loss):6.4e}')
+            if loss <= tol:
+                break
+        for solver,sampler,curriculum in zip(self.solvers,samplers,curricula):
+            solver.adaptive_sampler = sampler
+            solver.curriculum = curriculum
+        if self.save_checkpoint_iter > 0:
+            self.checkpoint.wait()
+
+    def save_iteration(self):
+        if self.save_model_iter > 0:
+            if self.iter % self.save_model_iter == 0:
+                self.save_models(self.folder_path, [f'model_1_{self.iter}',f'model_2_{self.iter}'])
+
+        if self.save_checkpoint_iter > 0:
+            if self.iter % self.save_checkpoint_iter == 0:
+                self.checkpoint.save(self.iter, self.precondition)
+
+    def compile_step(self, train_step, signature, precond, jit_compile=False):
+        name = 'P' if precond else 'r'
+        def step(X_batch):
+            self.traces[name] += 1
+            return train_step(X_batch, precond)
+        if jit_compile:
+            return tf.function(step, input_signature=[signature], jit_compile=True)
+        relaxed = tf.nest.map_structure(lambda spec: tf.TensorSpec([None]+spec.shape[1:], spec.dtype), signature)
+        return tf.function(step, input_signature=[relaxed])
+
+    def sync_epochs(self, N_left, N_sync, N_precond):
+        # epochs until the next host sync, ending chunks at the end of the
+        # preconditioning phase, at model saves and at resampling
+        K = min(N_sync, N_left)
+        if self.precondition:
+            K = min(K, N_precond + 1 - self.iter)
+        if self.save_model_iter > 0:
+            K = min(K, self.save_model_iter - self.iter % self.save_model_iter)
+        if self.save_checkpoint_iter > 0:
+            K = min(K, self.save_checkpoint_iter - self.iter % self.save_checkpoint_iter)
+        for solver in self.solvers:
+            for hook in [solver.adaptive_sampler, solver.PDE.active_set]:
+                if hook != None:
+                    K = min(K, hook.every - self.iter % hook.every)
+            K = min(K, solver.level_epochs(self.iter))
+        return max(K,1)
+
+    def flat_losses(self, L):
+        loss,L_loss = L
+        return [loss] + [L_loss[t] for t in self.L_names]
+
+    def unflat_losses(self, row):
+        return [row[0], dict(zip(self.L_names,row[1:]))]
     
 
-    def solve(self,N=1000, precond=False, N_precond=10, N_batches=1, save_model=0):
+    def solve(self,N=1000, precond=False, N_precond=10, N_batches=1, save_model=0, N_sync=1, save_checkpoint=0, N_checkpoints=3, jit_compile=False, N_lbfgs=0, lbfgs=None, least_squares=None, newton=None):
 
-        self.precondition = precond
+        if not self.resumed:
+            self.precondition = precond
         self.save_model_iter = save_model
-        optim1 = tf.keras.optimizers.Adam(learning_rate=self.solver1.lr)
-        optim2 = tf.keras.optimizers.Adam(learning_rate=self.solver2.lr)
-        optim = [optim1,optim2]
+        self.save_checkpoint_iter = save_checkpoint
+        if self.optimizers is None:
+            optim1 = tf.keras.optimizers.Adam(learning_rate=self.solver1.lr)
+            optim2 = tf.keras.optimizers.Adam(learning_rate=self.solver2.lr)
+            self.optimizers = [optim1,optim2]
+            for optimizer,solver in zip(self.optimizers,self.solvers):
+                build_optimizer(optimizer, solver.model.trainable_variables)
+        optim = self.optimizers
+        if least_squares != None or newton != None:
+            for optimizer,solver in zip(optim,self.solvers):
+                Least_Squares(**(least_squares or newton.get('least_squares') or dict())).warm_up(optimizer, solver.lr)
+
+        if save_checkpoint > 0:
+            directory = os.path.join(os.getcwd(),self.folder_path,'checkpoints')
+            models = [solver.model for solver in self.solvers]
+            histories = [self.history] + [solver.history for solver in self.solvers]
+            states = [state for solver in self.solvers for state in solver.checkpoint_states()]
+            self.checkpoint = Checkpoint_Manager(directory, models, optim, histories, max_to_keep=N_checkpoints, states=states)
 
         t0 = time()
-        self.main_loop(optim, N, N_precond, N_batches=N_batches)
+        if least_squares != None and not self.resumed:
+            self.solve_least_squares(least_squares)
+        if newton != None and not self.resumed:
+            self.solve_newton(optim, **newton, N_batches=N_batches, N_sync=N_sync, jit_compile=jit_compile)
+        if self.iter < N:
+            self.main_loop(optim, N - self.iter, N_precond, N_batches=N_batches, N_sync=N_sync, jit_compile=jit_compile)
+        if self.iter < N + N_lbfgs:
+            self.solve_LBFGS(N + N_lbfgs - self.iter, lbfgs, jit_compile=jit_compile)
         logger.info('Computation time: {} minutes'.format(int((time()-t0)/60)))
 
-        self.add_losses_NN()
-
-
-    def create_batches(self, N_batches):
-
-        number_batches = 1
-
-        dataset_X_r_1 = tf.data.Dataset.from_tensor_slices(self.solver1.PDE.X_r)
-        dataset_X_r_1 = dataset_X_r_1.shuffle(buffer_size=len(self.solver1.PDE.X_r))
-        batch_size = int(len(self.solver1.PDE.X_r)/number_batches)
-        batches_X_r_1 = dataset_X_r_1.batch(batch_size)
 
-        dataset_X_r_2 = tf.data.Dataset.from_tensor_slices(self.solver2.PDE.X_r)
-        dataset_X_r_2 = dataset_X_r_2.shuffle(buffer_size=len(self.solver2.PDE.X_r))
-        batch_size = int(len(self.solver2.PDE.X_r)/number_batches)
-        batches_X_r_2 = dataset_X_r_2.batch(batch_size)
-
-
-        number_batches = N_batches
-
-        dataset_X_r_P_1 = tf.data.Dataset.from_tensor_slices(self.solver1.PDE.X_r_P)
-        dataset_X_r_P_1 = dataset_X_r_P_1.shuffle(buffer_size=len(self.solver1.PDE.X_r_P))
-        batch_size = int(len(self.solver1.PDE.X_r_P)/number_batches)
-        batches_X_r_P_1 = dataset_X_r_P_1.batch(batch_size)
-        dataset_X_r_P_2 = tf.data.Dataset.from_tensor_slices(self.solver2.PDE.X_r_P)
-        dataset_X_r_P_2 = dataset_X_r_P_2.shuffle(buffer_size=len(self.solver2.PDE.X_r_P))
-        batch_size = int(len(self.solver2.PDE.X_r_P)/number_batches)
-        batches_X_r_P_2 = dataset_X_r_P_2.batch(batch_size)
-
-        return (batches_X_r_1, batches_X_r_2), (batches_X_r_P_1,batches_X_r_P_2)
+    def epoch_batches(self, N_batches, precond=False, drop_remainder=False):
+        # the batches of both subdomains are zipped in one dataset, built
+        # again when either point set changes
+        number_batches = N_batches if precond else 1
+        X = [solver.PDE.X_r_P_F if precond else solver.residual_points() for solver in self.solvers]
+        shards = [solver.mesh.streamed(precond) for solver in self.solvers]
+        layout = (number_batches,drop_remainder)
+        batches = self.batches.get(precond)
+        if batches is None or not batches.valid(X + shards, layout, self.iter):
+            (epoch1,N1),(epoch2,N2) = [solver.residual_batches(X_s, shards_s, number_batches, drop_remainder, precond)
+                                       for solver,X_s,shards_s in zip(self.solvers,X,shards)]
+            epoch = lambda e: tf.data.Dataset.zip((epoch1(self.seed + e), epoch2(self.seed + e)))
+            batches = Epoch_Batches(epoch, min(N1,N2), self.iter, X + shards, layout)
+            self.batches[precond] = batches
+        return batches
 
 
 
     def callback(self, L1,L2):
-        self.loss_r1.append(L1[1]['r'])
-        self.loss_bD1.append(L1[1]['D'])
-        self.loss_bN1.append(L1[1]['N'])
-        self.loss_bI1.append(L1[1]['I'])
-        self.loss_bK1.append(L1[1]['K'])
-
-        self.loss_r2.append(L2[1]['r'])
-        self.loss_bD2.append(L2[1]['D'])
-        self.loss_bN2.append(L2[1]['N'])
-        self.loss_bI2.append(L2[1]['I'])
-        self.loss_bK2.append(L2[1]['K'])
+        self.solver1.history.append([L1[0]] + [L1[1][t] for t in self.L_names])
+        self.solver2.history.append([L2[0]] + [L2[1][t] for t in self.L_names])
 
         loss = L1[0] + L2[0]
-        self.current_loss = loss.numpy()
-        self.loss_hist.append(self.current_loss)
+        self.current_loss = np.float32(loss)
+        self.history.append([loss])
         self.iter+=1
 
-    def add_losses_NN(self):
-        self.solver1.loss_r = self.loss_r1
-        self.solver1.loss_bD = self.loss_bD1
-        self.solver1.loss_bN = self.loss_bN1
-        self.solver1.loss_bI = self.loss_bI1
-        self.solver1.loss_bK = self.loss_bK1
-
-        self.solver2.loss_r = self.loss_r2
-        self.solver2.loss_bD = self.loss_bD2
-        self.solver2.loss_bN = self.loss_bN2
-        self.solver2.loss_bI = self.loss_bI2
-        self.solver2.loss_bK = self.loss_bK2
-
 
 
 if __name__=='__main__':
@@ -2,6 +2,10 @@ import json
 import logging
 
 from DCM.Mesh import Mesh
+from DCM.Mesh_Store import Mesh_Store
+from DCM.Adaptive_Sampler import Adaptive_Sampler
+from DCM.Active_Set import Active_Set
+from DCM.Molecule import Molecule
 from NN.NeuralNet import PINN_NeuralNet
 
 from NN.PINN import PINN
@@ -22,35 +26,78 @@ class Simulation():
           self.hyperparameters = None
           self.PDE_EQ = PDE
           self.precondition = False
+          self.mesh_cache = None
+          self.loss_every = 1
+          # coarse residual levels before the mesh, e.g. [{'N_r': 15, 'epochs': 100}]
+          self.curriculum = None
+          # options of the L-BFGS phase after Adam, e.g. {'m': 50}
+          self.lbfgs = None
+          # output layer least squares fit before training, e.g. {'method': 'qr'}
+          self.least_squares = None
+          # Newton iterations of a nonlinear PDE before training, e.g. {'iterations': 10, 'inner': 'least_squares'}
+          self.newton = None
+          self.adaptive = None
+          self.active_set = None
+
+    def molecule_charges(self):
+        # the charges of a molecule domain (PQR) replace the given ones, an
+        # XYZR file has none and keeps them
+        ins_domain = self.ins_domain_in
+        if 'molecule' in ins_domain:
+            molecule = Molecule.load(ins_domain['molecule'], probe=ins_domain.get('probe',1.4))
+            q_list = molecule.q_list()
+            if len(q_list) > 0:
+                self.q = q_list
+                self.PDE_in.q = q_list
 
     def setup_algorithm(self):
         
         logger.info("> Starting PINN Algorithm")
         logger.info(json.dumps(self.problem, indent=4))
+        self.molecule_charges()
         logger.info(json.dumps({'q': self.q}))
         
+        store = Mesh_Store(self.mesh_cache) if self.mesh_cache != None else None
+
+        if self.mesh.get('sampler') == 'graded':
+            # points cluster around the charges and the interface by default
+            grading = self.mesh.setdefault('grading', dict())
+            grading.setdefault('centers', [X for q,X in self.q])
+            grading.setdefault('rI', self.problem.get('rI'))
+
         PDE_in = self.PDE_in
         domain_in = PDE_in.set_domain(self.domain_in)
       
         mesh_in = Mesh(domain_in, mesh_N=self.mesh, precondition=self.precondition)
-        mesh_in.create_mesh(self.borders_in, self.ins_domain_in)
+        mesh_in.create_mesh(self.borders_in, self.ins_domain_in, store=store)
         mesh_in.plot_points_2d(self.folder_path, 'Mesh_2d_in')
         mesh_in.plot_points_3d(self.folder_path, 'Mesh_3d_in')
 
         PDE = self.PDE_EQ()
         PDE.epsilon_G = PDE_in.epsilon_G
+        PDE.derivatives = PDE_in.derivatives
+        PDE.treecode = PDE_in.treecode
         PDE.q = PDE_in.q
         PDE.kappa = PDE_in.kappa
         PDE.problem = self.problem
 
-        self.PINN_solver = PINN()
+        self.PINN_solver = PINN(loss_every=self.loss_every)
 
         self.PINN_solver.adapt_PDE(PDE)
 
         logger.info(json.dumps({'Mesh': self.mesh}, indent=4))
         self.PINN_solver.adapt_mesh(mesh_in,**self.weights)
+        if self.adaptive != None:
+            logger.info(json.dumps({'Adaptive sampling': self.adaptive}))
+            self.PINN_solver.adaptive_sampler = Adaptive_Sampler(PDE, **self.adaptive)
+        if self.active_set != None:
+            logger.info(json.dumps({'Active set': self.active_set}))
+            PDE.active_set = Active_Set(PDE, **self.active_set)
 
         self.PINN_solver.create_NeuralNet(PINN_NeuralNet,self.lr,**self.hyperparameters_in)
+        if self.curriculum != None:
+            logger.info(json.dumps({'Curriculum': self.curriculum}))
+            self.PINN_solver.set_curriculum(self.curriculum)
         
         logger.info(json.dumps({'hyperparameters in': self.hyperparameters_in}, indent=4))
         logger.info(json.dumps({'weights': self.weights}, indent=4))
@@ -59,12 +106,23 @@ class Simulation():
         self.PINN_solver.folder_path = self.folder_path
 
 
-    def solve_algorithm(self,N_iters, precond=False, N_precond=10, N_batches=1, save_model=0):
+    def solve_algorithm(self,N_iters, precond=False, N_precond=10, N_batches=1, save_model=0, N_sync=1, save_checkpoint=0, N_checkpoints=3, jit_compile=False, N_lbfgs=0):
         logger.info("> Solving PINN")
         if precond:
             logger.info(f'Preconditioning {N_precond} iterations')
         logger.info(f'Number Batches: {N_batches}')
-        self.PINN_solver.solve(N=N_iters, precond=precond, N_precond=N_precond, N_batches=N_batches, save_model=save_model)
+        if N_lbfgs > 0:
+            logger.info(f'L-BFGS {N_lbfgs} iterations')
+        if self.least_squares != None:
+            logger.info(json.dumps({'Least squares': self.least_squares}))
+        if self.newton != None:
+            logger.info(json.dumps({'Newton': self.newton}))
+        self.PINN_solver.solve(N=N_iters, precond=precond, N_precond=N_precond, N_batches=N_batches, save_model=save_model, N_sync=N_sync, save_checkpoint=save_checkpoint, N_checkpoints=N_checkpoints, jit_compile=jit_compile, N_lbfgs=N_lbfgs, lbfgs=self.lbfgs, least_squares=self.least_squares, newton=self.newton)
+
+
+    def resume(self,run_dir):
+        logger.info(f'> Resuming from {run_dir}')
+        self.PINN_solver.resume(run_dir)
 
 
     def postprocessing(self,folder_path):
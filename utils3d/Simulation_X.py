@@ -2,6 +2,10 @@ import json
 import logging
 
 from DCM.Mesh import Mesh
+from DCM.Mesh_Store import Mesh_Store
+from DCM.Adaptive_Sampler import Adaptive_Sampler
+from DCM.Active_Set import Active_Set
+from DCM.Molecule import Molecule
 from NN.NeuralNet import PINN_NeuralNet
 
 from NN.PINN import PINN
@@ -24,41 +28,94 @@ class Simulation():
           self.hyperparameters = None
           self.PDE_Interface = PDE
           self.precondition = False
+          self.mesh_cache = None
+          self.loss_every = 1
+          # coarse residual levels before the mesh, e.g. [{'N_r': 15, 'epochs': 100}]
+          self.curriculum = None
+          # options of the L-BFGS phase after Adam, e.g. {'m': 50}
+          self.lbfgs = None
+          # output layer least squares fit before training, e.g. {'method': 'qr'}
+          self.least_squares = None
+          # Newton iterations of a nonlinear PDE before training, e.g. {'iterations': 10, 'inner': 'least_squares'}
+          self.newton = None
+          self.adaptive_in = None
+          self.adaptive_out = None
+          self.active_set_in = None
+          self.active_set_out = None
+          # residual points drawn fresh each epoch instead of a stored mesh
+          self.stream_in = False
+          self.stream_out = False
+
+    def molecule_charges(self):
+        # the charges of a molecule domain (PQR) replace the given ones, an
+        # XYZR file has none and keeps them
+        for ins_domain in [self.ins_domain_in,self.ins_domain_out]:
+            if 'molecule' in ins_domain:
+                molecule = Molecule.load(ins_domain['molecule'], probe=ins_domain.get('probe',1.4))
+                q_list = molecule.q_list()
+                if len(q_list) > 0:
+                    self.q = q_list
+                    for PDE in [self.PDE_in,self.PDE_out]:
+                        PDE.q = q_list
+                return
 
     def setup_algorithm(self):
         
         logger.info("> Starting PINN Algorithm")
         logger.info(json.dumps(self.problem, indent=4))
+        self.molecule_charges()
         logger.info(json.dumps({'q': self.q}))
         
+        store = Mesh_Store(self.mesh_cache) if self.mesh_cache != None else None
+
+        if self.mesh.get('sampler') == 'graded':
+            # points cluster around the charges and the interface by default
+            grading = self.mesh.setdefault('grading', dict())
+            grading.setdefault('centers', [X for q,X in self.q])
+            grading.setdefault('rI', self.problem.get('rI'))
+
         PDE_in = self.PDE_in
         domain_in = PDE_in.set_domain(self.domain_in)
 
         PDE_out = self.PDE_out
         domain_out = PDE_out.set_domain(self.domain_out)
    
-        mesh_in = Mesh(domain_in, mesh_N=self.mesh, precondition=self.precondition)
-        mesh_in.create_mesh(self.borders_in, self.ins_domain_in)
+        mesh_in = Mesh(domain_in, mesh_N=dict(self.mesh, stream=self.stream_in), precondition=self.precondition)
+        mesh_in.create_mesh(self.borders_in, self.ins_domain_in, store=store)
         mesh_in.plot_points_2d(self.folder_path, 'Mesh_2d_in')
 
-        mesh_out = Mesh(domain_out, mesh_N=self.mesh, precondition=self.precondition)
-        mesh_out.create_mesh(self.borders_out, self.ins_domain_out)
+        mesh_out = Mesh(domain_out, mesh_N=dict(self.mesh, stream=self.stream_out), precondition=self.precondition)
+        mesh_out.create_mesh(self.borders_out, self.ins_domain_out, store=store)
         mesh_out.plot_points_2d(self.folder_path, 'Mesh_2d_out')
 
         PDE = self.PDE_Interface()
         PDE.adapt_PDEs([PDE_in,PDE_out],[PDE_in.epsilon,PDE_out.epsilon])
         PDE.epsilon_G = PDE_in.epsilon_G
+        PDE.derivatives = PDE_in.derivatives
+        PDE.treecode = PDE_in.treecode
         PDE.q = PDE_in.q
         PDE.problem = self.problem
 
-        self.XPINN_solver = XPINN(PINN)
+        self.XPINN_solver = XPINN(PINN, loss_every=self.loss_every)
 
         self.XPINN_solver.adapt_PDEs(PDE)
 
         logger.info(json.dumps({'Mesh': self.mesh}, indent=4))
         self.XPINN_solver.adapt_meshes([mesh_in,mesh_out],[self.weights,self.weights])
+        for solver,adaptive in zip(self.XPINN_solver.solvers,[self.adaptive_in,self.adaptive_out]):
+            if adaptive != None:
+                logger.info(json.dumps({'Adaptive sampling': adaptive}))
+                solver.adaptive_sampler = Adaptive_Sampler(solver.PDE, **adaptive)
+        for solver,active_set in zip(self.XPINN_solver.solvers,[self.active_set_in,self.active_set_out]):
+            if active_set != None:
+                logger.info(json.dumps({'Active set': active_set}))
+                solver.PDE.active_set = Active_Set(solver.PDE, **active_set)
 
         self.XPINN_solver.create_NeuralNets(PINN_NeuralNet,[self.lr,self.lr],[self.hyperparameters_in,self.hyperparameters_out])
+        if self.curriculum != None:
+            logger.info(json.dumps({'Curriculum': self.curriculum}))
+            for solver in self.XPINN_solver.solvers:
+                solver.set_curriculum(self.curriculum)
         
         logger.info(json.dumps({'hyperparameters in': self.hyperparameters_in}, indent=4))
         logger.info(json.dumps({'hyperparameters out': self.hyperparameters_out}, indent=4))
@@ -68,12 +125,23 @@ class Simulation():
         self.XPINN_solver.folder_path = self.folder_path
 
 
-    def solve_algorithm(self,N_iters, precond=False, N_precond=10, N_batches=1, save_model=0):
+    def solve_algorithm(self,N_iters, precond=False, N_precond=10, N_batches=1, save_model=0, N_sync=1, save_checkpoint=0, N_checkpoints=3, jit_compile=False, N_lbfgs=0):
         logger.info("> Solving XPINN")
         if precond:
             logger.info(f'Preconditioning {N_precond} iterations')
         logger.info(f'Number Batches: {N_batches}')
-        self.XPINN_solver.solve(N=N_iters, precond=precond, N_precond=N_precond, N_batches=N_batches, save_model=save_model)
+        if N_lbfgs > 0:
+            logger.info(f'L-BFGS {N_lbfgs} iterations')
+        if self.least_squares != None:
+            logger.info(json.dumps({'Least squares': self.least_squares}))
+        if self.newton != None:
+            logger.info(json.dumps({'Newton': self.newton}))
+        self.XPINN_solver.solve(N=N_iters, precond=precond, N_precond=N_precond, N_batches=N_batches, save_model=save_model, N_sync=N_sync, save_checkpoint=save_checkpoint, N_checkpoints=N_checkpoints, jit_compile=jit_compile, N_lbfgs=N_lbfgs, lbfgs=self.lbfgs, least_squares=self.least_squares, newton=self.newton)
+
+
+    def resume(self,run_dir):
+        logger.info(f'> Resuming from {run_dir}')
+        self.XPINN_solver.resume(run_dir)
 
 
     def postprocessing(self,folder_path):
@@ -84,6 +152,8 @@ class Simulation():
 
         Post.plot_loss_history();
         Post.plot_u_plane();
+        if hasattr(self.PDE_in,'coulomb_term'):
+            Post.plot_u_plane(total=True);
         Post.plot_u_domain_contour();
         Post.plot_aprox_analytic();
         Post.plot_interface();
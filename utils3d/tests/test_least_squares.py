@@ -0,0 +1,84 @@
+import os
+import sys
+os.environ.setdefault('TF_USE_LEGACY_KERAS','1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import tensorflow as tf
+
+from DCM.PDE_Model import Helmholtz
+from Simulation_1 import Simulation
+
+
+def shell_simulation(folder_path, least_squares):
+    # Helmholtz on the shell 4 < r < 10 with the analytic solution on both
+    # borders, wide random features as in the random feature (ELM) mode
+    tf.keras.utils.set_random_seed(0)
+    Sim = Simulation(Helmholtz)
+    q_list = [(1000,[0,0,0])]
+    inputs = {'Problem':'Main','rmin':4,'rB':10,'rI':1,'epsilon_1':1,'epsilon_2':80,'kappa':0.125}
+    Sim.problem = inputs
+    Sim.q = q_list
+    rB = 10
+    Sim.domain_in = ([-rB,rB],[-rB,rB],[-rB,rB])
+    PDE = Helmholtz()
+    PDE.sigma = 0.04
+    PDE.epsilon = 1
+    PDE.epsilon_G = 1
+    PDE.q = q_list
+    PDE.kappa = 0.125
+    PDE.problem = inputs
+    Sim.PDE_in = PDE
+
+    analytic = lambda x,y,z: PDE.analytic(x,y,z)
+    Sim.borders_in = {'1':{'type':'D','fun':analytic,'value':None,'dr':None,'r':rB,'N':10},
+                      '2':{'type':'D','fun':analytic,'value':None,'dr':None,'r':4,'N':10}}
+    Sim.ins_domain_in = {'rmax': rB, 'rmin': 4}
+    Sim.mesh = {'N_r': 40, 'N_r_P': 0}
+    Sim.weights = {'w_r':1,'w_d':1,'w_n':1,'w_i':1,'w_k':1}
+    Sim.lr = ([3000,6000],[1e-2,5e-3,5e-4])
+    Sim.hyperparameters_in = {'input_shape':(None,3),'num_hidden_layers':1,'num_neurons_per_layer':400,'output_dim':1,'activation':'tanh','architecture_Net':'FCNN',
+                              'kernel_initializer':{'class_name':'RandomNormal','config':{'stddev':5.0}},
+                              'bias_initializer':{'class_name':'RandomUniform','config':{'minval':-5.0,'maxval':5.0}}}
+    Sim.least_squares = least_squares
+    Sim.folder_path = folder_path
+    Sim.setup_algorithm()
+    return Sim
+
+
+def relative_error(Sim):
+    rng = np.random.default_rng(1)
+    d = rng.standard_normal((2000,3))
+    d /= np.linalg.norm(d, axis=1, keepdims=True)
+    r = rng.uniform(4.2, 9.8, 2000)
+    X = (d*r[:,None]).astype(np.float32)
+    u = Sim.PINN_solver.model(X).numpy()[:,0]
+    u_an = Sim.PDE_in.analytic(X[:,0:1],X[:,1:2],X[:,2:3]).numpy()[:,0]
+    return np.sqrt(np.mean((u-u_an)**2)/np.mean(u_an**2))
+
+
+def test_fit_matches_analytic(tmp_path):
+    Sim = shell_simulation(str(tmp_path), {'method':'qr'})
+    Sim.solve_algorithm(N_iters=1, precond=False, N_batches=1)
+    assert relative_error(Sim) < 0.15
+
+
+def test_adam_after_fit_keeps_solution(tmp_path):
+    # the first Adam steps after the fit are warmed up
+    Sim = shell_simulation(str(tmp_path), {'method':'qr'})
+    Sim.solve_algorithm(N_iters=20, precond=False, N_batches=1)
+    loss_hist = Sim.PINN_solver.loss_hist
+    assert loss_hist[-1] < 2*loss_hist[0]
+    assert relative_error(Sim) < 0.15
+
+
+def test_lsqr_matches_qr(tmp_path):
+    errors = list()
+    for method in ['qr','lsqr']:
+        Sim = shell_simulation(str(tmp_path), {'method':method})
+        Sim.solve_algorithm(N_iters=1, precond=False, N_batches=1)
+        errors.append(relative_error(Sim))
+    assert errors[1] < 0.15
+    assert abs(errors[1] - errors[0]) < 0.05